@@ -0,0 +1,48 @@
+"""
+Compare :in_bbox() selectors run as XPath with the same selectors answered
+from the per-page bbox index, for a form template's worth of field boxes.
+"""
+from __future__ import print_function
+
+import random
+
+from common import sample_path, best_time, report
+
+import pdfquery
+from pdfquery.pdftranslator import PDFQueryTranslator
+from pyquery import PyQuery
+
+
+def field_selectors(count=300, seed=0):
+    """ Small field-sized boxes scattered over a letter-size page. """
+    rnd = random.Random(seed)
+    selectors = []
+    for _ in range(count):
+        x0, y0 = rnd.uniform(20, 500), rnd.uniform(20, 740)
+        selectors.append('LTTextLineHorizontal:in_bbox("%.1f,%.1f,%.1f,%.1f")' % (
+            x0, y0, x0 + rnd.uniform(40, 120), y0 + rnd.uniform(8, 20)))
+    return selectors
+
+
+def run():
+    pdf = pdfquery.PDFQuery(sample_path('IRS_1040A.pdf'))
+    pdf.load()
+    plain = PyQuery(pdf.tree.getroot(), css_translator=PDFQueryTranslator())
+    selectors = field_selectors()
+    assert [list(plain(s)) for s in selectors] == [list(pdf.pq(s)) for s in selectors]
+
+    def indexed():
+        # drop the indexes so building them is part of the timing
+        pdf.tree.getroot()._bbox_indexes = {}
+        for s in selectors:
+            pdf.pq(s)
+
+    report("IRS_1040A.pdf, %s :in_bbox selectors" % len(selectors), [
+        ("XPath", best_time(lambda: [plain(s) for s in selectors])),
+        ("bbox index, including build", best_time(indexed)),
+        ("bbox index, already built", best_time(lambda: [pdf.pq(s) for s in selectors])),
+    ])
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,72 @@
+"""
+Compare a cold parse of the sample document with loading it from the parse
+tree cache: the zipped XML files FileCache used to write, the current
+FileCache format with each available codec, and MemoryLRUCache.
+"""
+from __future__ import print_function
+
+import os
+import shutil
+import tempfile
+import zipfile
+
+from common import sample_path, best_time, report
+
+import pdfquery
+from pdfquery import cache
+from pdfquery.cache import FileCache, MemoryLRUCache
+from lxml import etree
+
+
+class ZipXMLCache(FileCache):
+    """ The format FileCache used before serialize_tree(). """
+
+    def get_cache_path(self, page_range_key):
+        return self.directory + self.get_cache_filename(page_range_key) + ".zip"
+
+    def set(self, page_range_key, tree):
+        xml = etree.tostring(tree, encoding='utf-8', pretty_print=False, xml_declaration=True)
+        with zipfile.ZipFile(self.get_cache_path(page_range_key), 'w', zipfile.ZIP_DEFLATED) as cache_file:
+            cache_file.writestr(self.get_cache_filename(page_range_key), xml)
+
+    def get(self, page_range_key):
+        try:
+            cache_file = zipfile.ZipFile(self.get_cache_path(page_range_key), 'r')
+        except IOError:
+            return None
+        return etree.fromstring(cache_file.read(self.get_cache_filename(page_range_key)))
+
+
+def run():
+    path = sample_path('IRS_1040A.pdf')
+    directory = tempfile.mkdtemp() + '/'
+    try:
+        def subdirectory(name):
+            os.mkdir(directory + name)
+            return directory + name + '/'
+        caches = [("zipped XML (old FileCache)", ZipXMLCache(subdirectory('zip')))]
+        caches += [("FileCache codec=%s" % codec, FileCache(subdirectory(str(codec)), codec=codec))
+                   for codec in cache._codecs]
+        caches += [("MemoryLRUCache", MemoryLRUCache())]
+
+        def cold_parse():
+            pdf = pdfquery.PDFQuery(path)
+            pdf.load()
+            return pdf
+        rows = [("cold parse", best_time(cold_parse, repeat=1))]
+
+        for label, cacher in caches:
+            pdf = pdfquery.PDFQuery(path, parse_tree_cacher=cacher)
+            pdf.load()
+            keys = [pdf._page_cache_key(n) for n in range(len(pdf.tree.getroot()))]
+            size = sum(os.path.getsize(cacher.get_cache_path(key, pdf._hash_key)) for key in keys) \
+                if hasattr(cacher, 'get_cache_path') else cacher.stats.bytes
+            rows.append(("%s hit (%s KB)" % (label, size // 1024),
+                         best_time(lambda: [cacher.get(key, pdf._hash_key) for key in keys], repeat=30)))
+        report("IRS_1040A.pdf, all pages", rows)
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,64 @@
+"""
+Time removing children's text from their parents' text on text-heavy pages:
+a synthetic page of large text boxes, and IRS_1040A.pdf as loaded.
+"""
+from __future__ import print_function
+
+import copy
+import random
+
+from common import sample_path, best_time, report
+
+import pdfquery
+from pdfquery.pdfquery import parser
+
+
+def legacy_clean_text(pdf, branch):
+    """ _clean_text as it was before cursor-based removal. """
+    if branch.text and pdf.input_text_formatter:
+        branch.text = pdf.input_text_formatter(branch.text)
+    try:
+        for child in branch:
+            legacy_clean_text(pdf, child)
+            if branch.text and branch.text.find(child.text) >= 0:
+                branch.text = branch.text.replace(child.text, '', 1)
+    except TypeError:
+        pass
+
+
+def text_heavy_page(boxes=20, lines=200, words=12):
+    """ A page of text boxes each holding many lines, with the lines' text
+    repeated in the box text as pdfminer produces it. """
+    rnd = random.Random(0)
+    page = parser.makeelement('LTPage')
+    for _ in range(boxes):
+        box = parser.makeelement('LTTextBoxHorizontal')
+        for _ in range(lines):
+            line = parser.makeelement('LTTextLineHorizontal')
+            line.text = ' '.join(
+                ''.join(rnd.choice('abcdefghij') for _ in range(rnd.randrange(2, 9)))
+                for _ in range(words)) + '\n'
+            box.append(line)
+        box.text = ''.join(line.text for line in box)
+        page.append(box)
+    return page
+
+
+def run():
+    pdf = pdfquery.PDFQuery(sample_path('IRS_1040A.pdf'))
+    irs = parser.makeelement('LTPage')
+    irs.extend(pdf._build_page(n, pdf.get_layout(n)) for n in range(2))
+    for title, page in (
+            ("synthetic page, 20 boxes x 200 lines", text_heavy_page()),
+            ("IRS_1040A.pdf, 2 pages", irs),
+    ):
+        rows = [
+            ("search and replace", best_time(lambda: legacy_clean_text(pdf, copy.deepcopy(page)))),
+            ("cursor", best_time(lambda: pdf._clean_text(copy.deepcopy(page)))),
+            ("copy only", best_time(lambda: copy.deepcopy(page))),
+        ]
+        report("_clean_text, " + title, rows)
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,71 @@
+"""
+Compare extract() as it used to run -- translating and evaluating each
+selector with pyquery in turn -- with the same loop over pdf.pq, which
+memoizes compiled selectors, and with compiled ExtractionPlans, for a form
+template of a few hundred fields on IRS_1040A.pdf.
+"""
+from __future__ import print_function
+
+import random
+
+from common import sample_path, best_time, report
+
+import pdfquery
+from pdfquery.pdftranslator import PDFQueryTranslator
+from pyquery import PyQuery
+
+
+def template(fields_per_page=120, seed=0):
+    """ Field-sized bbox selectors on both pages, plus some label lookups. """
+    rnd = random.Random(seed)
+    searches = [('with_formatter', 'text')]
+    for pageid in (1, 2):
+        searches.append(('with_parent', 'LTPage[pageid="%s"]' % pageid))
+        for i in range(fields_per_page):
+            x0, y0 = rnd.uniform(20, 500), rnd.uniform(20, 740)
+            searches.append(('field_%s_%s' % (pageid, i), 'LTTextLineHorizontal:in_bbox("%.1f,%.1f,%.1f,%.1f")' % (
+                x0, y0, x0 + rnd.uniform(40, 120), y0 + rnd.uniform(8, 20))))
+        for word in ('Form', 'Total', 'Income', 'Tax', 'Amount'):
+            searches.append(('label_%s_%s' % (pageid, word), 'LTTextLineHorizontal:contains("%s")' % word))
+    return searches
+
+
+def legacy_extract(pq, searches):
+    """ extract() before ExtractionPlan, for comparison. """
+    results = []
+    formatter = None
+    parent = pq
+    for search in searches:
+        if len(search) < 3:
+            search = list(search) + [formatter]
+        key, search, tmp_formatter = search
+        if key == 'with_formatter':
+            formatter = lambda o, search=search: getattr(o, search)()
+        elif key == 'with_parent':
+            parent = pq(search) if search else pq
+        else:
+            result = parent(search)
+            if tmp_formatter:
+                result = tmp_formatter(result)
+            results += [[key, result]]
+    return dict(results)
+
+
+def run():
+    pdf = pdfquery.PDFQuery(sample_path('IRS_1040A.pdf'))
+    pdf.load()
+    plain = PyQuery(pdf.tree.getroot(), css_translator=PDFQueryTranslator())
+    searches = template()
+    plan = pdfquery.ExtractionPlan(searches)
+    assert legacy_extract(plain, searches) == pdf.extract(searches) == pdf.extract(plan)
+
+    report("IRS_1040A.pdf, %s fields" % sum(1 for s in searches if not s[0].startswith('with_')), [
+        ("pyquery per selector", best_time(lambda: legacy_extract(plain, searches))),
+        ("pdf.pq per selector", best_time(lambda: legacy_extract(pdf.pq, searches))),
+        ("extract(searches)", best_time(lambda: pdf.extract(searches))),
+        ("extract(plan), plan reused", best_time(lambda: pdf.extract(plan))),
+    ])
+
+
+if __name__ == '__main__':
+    run()
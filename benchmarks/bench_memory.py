@@ -0,0 +1,50 @@
+"""
+Open, load and query many documents one after another, as a long-running
+service would, and print the process's resident memory along the way. With
+each PDFQuery closed when done, memory should level off after the first few
+documents instead of growing with every document.
+
+    python benchmarks/bench_memory.py [documents]
+"""
+from __future__ import print_function
+
+import gc
+import resource
+import sys
+
+from common import sample_path
+
+import pdfquery
+
+
+def rss_mb():
+    """ Current resident set size in MB, or the peak if the current size
+    can't be read. """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize() / 1e6
+    except IOError:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 1e6 if sys.platform == 'darwin' else peak / 1e3
+
+
+def process(path, **options):
+    with pdfquery.PDFQuery(path, **options) as pdf:
+        pdf.load()
+        return pdf.extract([('text', 'LTTextLineHorizontal')])
+
+
+def run(documents=1000):
+    path = sample_path('bug37.pdf')
+    for label, options in (("keep_layout=True", {}), ("keep_layout=False", dict(keep_layout=False))):
+        print("RSS while processing %s documents, %s" % (documents, label))
+        checkpoints = set([1, 10] + list(range(documents // 10, documents + 1, max(1, documents // 10))))
+        for i in range(1, documents + 1):
+            process(path, **options)
+            if i in checkpoints:
+                gc.collect()
+                print("  %6s documents %9.1f MB" % (i, rss_mb()))
+
+
+if __name__ == '__main__':
+    run(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,109 @@
+"""
+Compare the incremental _append_sorted() nesting with spatial.nest_by_bbox()
+on the sample document and on a synthetic dense form page, and sorting each
+element's children recursively with PDFQuery._sort().
+"""
+from __future__ import print_function
+
+import copy
+import random
+
+from common import sample_path, best_time, report
+
+import pdfquery
+from pdfquery.pdfquery import _append_sorted, _comp_bbox, parser
+from pdfquery.spatial import nest_by_bbox
+from lxml import etree
+
+
+def sample_elements(path):
+    """ Unsorted elements of each page, in the order _xmlize generates them. """
+    pdf = pdfquery.PDFQuery(path, resort=False)
+    pages = []
+    for layout in pdf.get_layouts():
+        elements = []
+
+        def collect(branch):
+            for child in branch:
+                collect(child)
+                elements.append(parser.makeelement(child.tag, dict(child.attrib)))
+        collect(pdf._xmlize(layout))
+        pages.append(elements)
+    return pages
+
+
+def form_elements(rows=60, cols=12, seed=0):
+    """ A table of cell rects, each holding a text line and its text box. """
+    rnd = random.Random(seed)
+    elements = []
+    for row in range(rows):
+        for col in range(cols):
+            x0, y0 = 20 + col * 48, 20 + row * 12
+            tx0, ty0 = x0 + rnd.uniform(1, 4), y0 + rnd.uniform(1, 3)
+            tx1, ty1 = tx0 + rnd.uniform(10, 40), ty0 + 7
+            for tag, box in (('LTTextLineHorizontal', (tx0, ty0, tx1, ty1)),
+                             ('LTTextBoxHorizontal', (tx0, ty0, tx1, ty1)),
+                             ('LTRect', (x0, y0, x0 + 48, y0 + 12))):
+                elements.append(parser.makeelement(tag, dict(
+                    zip(('x0', 'y0', 'x1', 'y1'), ['%.3f' % v for v in box]))))
+    return [elements]
+
+
+def legacy(pages):
+    roots = []
+    for elements in pages:
+        roots.append(parser.makeelement('LTPage'))
+        for el in elements:
+            _append_sorted(roots[-1], el, _comp_bbox)
+    return roots
+
+
+def indexed(pages):
+    roots = []
+    for elements in pages:
+        roots.append(parser.makeelement('LTPage'))
+        nest_by_bbox(roots[-1], elements)
+    return roots
+
+
+def recursive_sort(tree):
+    """ PDFQuery._sort() before it sorted the whole page in one pass. """
+    children = list(tree)
+    if children:
+        tree[:] = sorted(children, key=lambda child: (-float(child.get('y1')), float(child.get('x0'))))
+        for child in children:
+            recursive_sort(child)
+
+
+def run_sort():
+    pdf = pdfquery.PDFQuery(sample_path('IRS_1040A.pdf'), char_level='full', resort=False)
+    # keep characters, which have positions, and leave out LTAnno, which don't
+    pages = [pdf._xmlize(layout) for layout in pdf.get_layouts()]
+    for page in pages:
+        for anno in list(page.iter('LTAnno')):
+            anno.getparent().remove(anno)
+    count = sum(len(list(page.iter())) for page in pages)
+    assert [etree.tostring(recursive_sort(page) or page) for page in copy.deepcopy(pages)] == \
+        [etree.tostring(pdf._sort(page) or page) for page in copy.deepcopy(pages)]
+    report("IRS_1040A.pdf with characters, sorting %s elements" % count, [
+        ("recursive sort", best_time(lambda: [recursive_sort(page) for page in pages])),
+        ("_sort", best_time(lambda: [pdf._sort(page) for page in pages])),
+    ])
+
+
+def run():
+    for title, pages in (
+            ("IRS_1040A.pdf (%s elements)", sample_elements(sample_path('IRS_1040A.pdf'))),
+            ("synthetic form page (%s elements)", form_elements())):
+        count = sum(len(elements) for elements in pages)
+        assert [etree.tostring(root) for root in legacy(copy.deepcopy(pages))] == \
+            [etree.tostring(root) for root in indexed(copy.deepcopy(pages))]
+        report(title % count, [
+            ("_append_sorted", best_time(lambda: legacy(copy.deepcopy(pages)))),
+            ("nest_by_bbox", best_time(lambda: indexed(copy.deepcopy(pages)))),
+        ])
+
+
+if __name__ == '__main__':
+    run()
+    run_sort()
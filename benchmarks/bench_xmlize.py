@@ -0,0 +1,38 @@
+"""
+Time converting IRS_1040A.pdf's pdfminer layouts to elements with different
+options, and count the elements allocated along the way and kept in the tree.
+"""
+from __future__ import print_function
+
+from common import sample_path, best_time, report
+
+import pdfquery
+
+
+def build(options):
+    pdf = pdfquery.PDFQuery(sample_path('IRS_1040A.pdf'), **options)
+    layouts = [pdf.get_layout(n) for n in range(2)]
+
+    def run():
+        return [pdf._build_page(n, layout) for n, layout in enumerate(layouts)]
+    return pdf, run
+
+
+def run():
+    rows = []
+    for label, options in (
+            ("full", dict(char_level='full')),
+            ("merge", dict()),
+            ("drop", dict(char_level='drop')),
+            ("drop, bbox attributes only", dict(char_level='drop', attributes=())),
+    ):
+        pdf, fn = build(options)
+        pages = fn()
+        label += ": %s/%s" % (sum(len(page._elements) + 1 for page in pages),
+                              sum(len(list(page.iter())) for page in pages))
+        rows.append((label, best_time(fn)))
+    report("IRS_1040A.pdf layouts to elements, by char_level and attributes", rows)
+
+
+if __name__ == '__main__':
+    run()
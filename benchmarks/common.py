@@ -0,0 +1,63 @@
+"""
+Shared helpers for the benchmark scripts in this directory.
+
+Run a benchmark from the repository root, e.g.::
+
+    python benchmarks/bench_resort.py
+
+or run the whole suite with benchmarks/run.py.
+"""
+from __future__ import print_function
+
+import os
+import sys
+import time
+
+try:
+    import tracemalloc
+except ImportError:  # Python < 3.4
+    tracemalloc = None
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SAMPLES = os.path.join(ROOT, 'tests', 'samples')
+
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+
+def sample_path(name):
+    return os.path.join(SAMPLES, name)
+
+
+def best_time(fn, repeat=3):
+    """ Call fn() repeat times and return the fastest wall time in seconds. """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def peak_memory(fn):
+    """ Call fn() once and return the peak memory it allocated through
+    Python's allocator, in bytes, or None if tracemalloc isn't available.
+    Memory libxml2 allocates for lxml trees isn't counted. """
+    if tracemalloc is None:
+        return None
+    tracemalloc.start()
+    try:
+        fn()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def report(title, rows):
+    """ Print (label, seconds) rows, with each row's speedup over the first. """
+    print(title)
+    baseline = rows[0][1]
+    for label, seconds in rows:
+        print("  %-40s %9.2f ms  %6.1fx" % (label, seconds * 1000, baseline / seconds if seconds else 0))
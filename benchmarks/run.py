@@ -0,0 +1,257 @@
+"""
+Run every benchmark case and print its best time and peak Python memory,
+optionally saving the numbers as JSON and comparing them with an earlier
+run::
+
+    python benchmarks/run.py -o before.json
+    (make changes)
+    python benchmarks/run.py -o after.json --compare before.json
+
+Use -k to run only cases whose names contain a string, e.g. -k load/.
+Cases use the sample documents and synthetic PDFs from synthetic.py.
+"""
+from __future__ import print_function
+
+import argparse
+import copy
+import json
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+from collections import OrderedDict
+
+from common import sample_path, best_time, peak_memory
+
+import pdfquery
+from pdfquery.cache import FileCache
+from six import BytesIO
+
+import bench_bbox
+import bench_clean_text
+import bench_extract
+import bench_resort
+import synthetic
+
+cases = OrderedDict()
+
+
+def case(name):
+    """ Register a benchmark. The decorated function does any setup and
+    returns the function to time. """
+    def register(setup):
+        cases[name] = setup
+        return setup
+    return register
+
+
+def _synthetic_file(pages, glyphs, rects):
+    data = synthetic.make_pdf(pages, glyphs, rects)
+    return lambda: BytesIO(data)
+
+
+_documents = OrderedDict([
+    ('IRS_1040A.pdf', lambda: sample_path('IRS_1040A.pdf')),
+    ('synthetic 4x3000 glyphs', _synthetic_file(4, 3000, 50)),
+    ('synthetic 4x500 rects', _synthetic_file(4, 300, 500)),
+])
+
+
+def _load(document, **options):
+    def run():
+        pdf = pdfquery.PDFQuery(document(), **options)
+        pdf.load()
+        return pdf
+    return run
+
+
+for _name, _document in _documents.items():
+    case('load/%s/resort' % _name)(lambda document=_document: _load(document))
+    case('load/%s/no resort' % _name)(lambda document=_document: _load(document, resort=False))
+
+
+@case('load/IRS_1040A.pdf/memory_map')
+def load_memory_map():
+    return _load(_documents['IRS_1040A.pdf'], memory_map=True)
+
+
+@case('resort/nest_by_bbox synthetic form page')
+def resort_form():
+    pages = bench_resort.form_elements()
+    return lambda: bench_resort.indexed(copy.deepcopy(pages))
+
+
+@case('resort/_sort IRS_1040A.pdf')
+def resort_sort():
+    pdf = pdfquery.PDFQuery(sample_path('IRS_1040A.pdf'), resort=False)
+    pages = [pdf._xmlize(layout) for layout in pdf.get_layouts()]
+    return lambda: [pdf._sort(page) for page in copy.deepcopy(pages)]
+
+
+@case('clean_text/synthetic text-heavy page')
+def clean_text():
+    pdf = pdfquery.PDFQuery(sample_path('IRS_1040A.pdf'))
+    page = bench_clean_text.text_heavy_page()
+    return lambda: pdf._clean_text(copy.deepcopy(page))
+
+
+_temporary_directories = []
+
+
+def _cache_directory():
+    directory = tempfile.mkdtemp() + '/'
+    _temporary_directories.append(directory)
+    return directory
+
+
+@case('cache/IRS_1040A.pdf/cold')
+def cache_cold():
+    def run():
+        pdf = pdfquery.PDFQuery(sample_path('IRS_1040A.pdf'), parse_tree_cacher=FileCache(_cache_directory()))
+        pdf.load()
+    return run
+
+
+@case('cache/IRS_1040A.pdf/warm')
+def cache_warm():
+    directory = _cache_directory()
+    pdfquery.PDFQuery(sample_path('IRS_1040A.pdf'), parse_tree_cacher=FileCache(directory)).load()
+
+    def run():
+        pdf = pdfquery.PDFQuery(sample_path('IRS_1040A.pdf'), parse_tree_cacher=FileCache(directory))
+        pdf.load()
+    return run
+
+
+@case('extract/IRS_1040A.pdf/250 fields')
+def extract_fields():
+    pdf = _load(_documents['IRS_1040A.pdf'])()
+    searches = bench_extract.template()
+    return lambda: pdf.extract(searches)
+
+
+@case('in_bbox/IRS_1040A.pdf/300 selectors')
+def in_bbox():
+    pdf = _load(_documents['IRS_1040A.pdf'])()
+    selectors = bench_bbox.field_selectors()
+
+    def run():
+        pdf.tree.getroot()._bbox_indexes = {}
+        for selector in selectors:
+            pdf.pq(selector)
+    return run
+
+
+@case('in_bbox/synthetic 4x3000 glyphs/300 selectors')
+def in_bbox_synthetic():
+    pdf = _load(_documents['synthetic 4x3000 glyphs'])()
+    selectors = bench_bbox.field_selectors()
+
+    def run():
+        pdf.tree.getroot()._bbox_indexes = {}
+        for selector in selectors:
+            pdf.pq(selector)
+    return run
+
+
+@case('decode/2000 annotation-like byte strings')
+def decode_strings():
+    from pdfquery.pdfquery import smart_unicode_decode, _decode_cache
+    values = [b'Caf\xe9 total', b'\xfe\xff\x00T\x00o\x00t\x00a\x00l'] + \
+        [b'Stra\xdfe %d' % (i % 50) for i in range(2000)]
+
+    def run():
+        _decode_cache.clear()
+        return [smart_unicode_decode(value) for value in values]
+    return run
+
+
+def _field_bboxes():
+    return [tuple(map(float, selector.split('"')[1].split(','))) for selector in bench_bbox.field_selectors()]
+
+
+@case('text/IRS_1040A.pdf/300 bboxes via load and selectors')
+def text_selectors():
+    selectors = ['LTPage[page_index="0"] LTTextLineHorizontal:in_bbox("%s,%s,%s,%s")' % bbox
+                 for bbox in _field_bboxes()]
+
+    def run():
+        pdf = pdfquery.PDFQuery(sample_path('IRS_1040A.pdf'))
+        pdf.load(0)
+        return [pdf.pq(selector).text() for selector in selectors]
+    return run
+
+
+@case('text/IRS_1040A.pdf/300 bboxes via text_in_bboxes')
+def text_fast_path():
+    bboxes = _field_bboxes()
+    return lambda: pdfquery.PDFQuery(sample_path('IRS_1040A.pdf')).text_in_bboxes(0, bboxes)
+
+
+def run_cases(names, repeat):
+    results = OrderedDict()
+    for name in names:
+        fn = cases[name]()
+        results[name] = OrderedDict([
+            ('seconds', best_time(fn, repeat=repeat)),
+            ('peak_python_bytes', peak_memory(fn)),
+        ])
+        print_result(name, results[name])
+    return results
+
+
+def print_result(name, result, baseline=None):
+    line = "%-50s %10.2f ms" % (name, result['seconds'] * 1000)
+    if result['peak_python_bytes'] is not None:
+        line += " %10.1f MB peak" % (result['peak_python_bytes'] / 1e6)
+    if baseline:
+        line += "   %5.2fx time vs baseline" % (result['seconds'] / baseline['seconds'])
+    print(line)
+
+
+def git_revision():
+    """ The checked out commit, with '+' if there are uncommitted changes, or
+    None if it can't be found. """
+    try:
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        revision = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=root).decode().strip()
+        dirty = subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=root)
+        return revision + ('+' if dirty.strip() else '')
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-k', dest='keyword', default='', help="only run cases whose names contain this")
+    parser.add_argument('-o', dest='output', help="write results to this JSON file")
+    parser.add_argument('--compare', help="JSON results of an earlier run to compare with")
+    parser.add_argument('--repeat', type=int, default=3, help="time each case this many times and keep the best")
+    args = parser.parse_args(argv)
+
+    names = [name for name in cases if args.keyword in name]
+    try:
+        results = run_cases(names, args.repeat)
+    finally:
+        for directory in _temporary_directories:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        print("\nCompared with %s" % args.compare)
+        for name, result in results.items():
+            print_result(name, result, baseline.get(name))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(OrderedDict([
+                ('python', platform.python_version()),
+                ('revision', git_revision()),
+                ('results', results),
+            ]), f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
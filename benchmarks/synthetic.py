@@ -0,0 +1,75 @@
+"""
+Generate PDFs of a given size for benchmarks, without any PDF library:
+pages of Helvetica text lines and stroked rectangles at random positions.
+"""
+from __future__ import print_function
+
+import random
+
+_words = ('form tax income total amount name address date number return '
+          'schedule line page credit payment refund').split()
+
+
+def _text_lines(rnd, glyphs, chars_per_line=60):
+    """ Yield (x, y, text) for lines holding `glyphs` characters in all,
+    in three columns of 6pt text on a letter-size page. """
+    for i in range(0, glyphs, chars_per_line):
+        text = ''
+        while len(text) < chars_per_line:
+            text += rnd.choice(_words) + ' '
+        line = i // chars_per_line
+        column, row = (line // 100) % 3, line % 100
+        yield 36 + column * 190, 750 - row * 7, text[:min(chars_per_line, glyphs - i)]
+
+
+def page_content(rnd, glyphs, rects):
+    ops = ['BT /F1 6 Tf %d %d Td (%s) Tj ET' % line for line in _text_lines(rnd, glyphs)]
+    for _ in range(rects):
+        x, y = rnd.uniform(20, 560), rnd.uniform(20, 740)
+        ops.append('%.1f %.1f %.1f %.1f re S' % (x, y, rnd.uniform(5, 60), rnd.uniform(5, 30)))
+    return '\n'.join(ops).encode('latin-1')
+
+
+def make_pdf(pages=1, glyphs=2000, rects=100, seed=0):
+    """ Return the bytes of a PDF with `pages` pages, each with `glyphs`
+    characters of text and `rects` rectangles. """
+    rnd = random.Random(seed)
+    objects = []
+
+    def add(body):
+        objects.append(body)
+        return len(objects)
+
+    font = add(b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>')
+    pages_id = add(None)  # filled in once the pages exist
+    kids = []
+    for _ in range(pages):
+        content = page_content(rnd, glyphs, rects)
+        stream = add(('<< /Length %d >>\nstream\n' % len(content)).encode('latin-1') + content + b'\nendstream')
+        kids.append(add(('<< /Type /Page /Parent %d 0 R /MediaBox [0 0 612 792] '
+                         '/Resources << /Font << /F1 %d 0 R >> >> /Contents %d 0 R >>'
+                         % (pages_id, font, stream)).encode('latin-1')))
+    objects[pages_id - 1] = ('<< /Type /Pages /Kids [%s] /Count %d >>' % (
+        ' '.join('%d 0 R' % kid for kid in kids), len(kids))).encode('latin-1')
+    catalog = add(('<< /Type /Catalog /Pages %d 0 R >>' % pages_id).encode('latin-1'))
+
+    out = [b'%PDF-1.4\n']
+    offsets = []
+    position = len(out[0])
+    for number, body in enumerate(objects, 1):
+        chunk = ('%d 0 obj\n' % number).encode('latin-1') + body + b'\nendobj\n'
+        offsets.append(position)
+        out.append(chunk)
+        position += len(chunk)
+    xref = ['xref', '0 %d' % (len(objects) + 1), '0000000000 65535 f ']
+    xref += ['%010d 00000 n ' % offset for offset in offsets]
+    out.append(('\n'.join(xref) + '\ntrailer\n<< /Size %d /Root %d 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (
+        len(objects) + 1, catalog, position)).encode('latin-1'))
+    return b''.join(out)
+
+
+if __name__ == '__main__':
+    import sys
+    sizes = [int(arg) for arg in sys.argv[2:]]
+    with open(sys.argv[1], 'wb') as f:
+        f.write(make_pdf(*sizes))
@@ -1 +1,3 @@
-from .pdfquery import PDFQuery
\ No newline at end of file
+from .pdfquery import PDFQuery, ExtractionPlan, compile, selector_cache_stats
+from .batch import batch_extract
+from .stats import PDFQueryStats
\ No newline at end of file
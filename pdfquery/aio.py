@@ -0,0 +1,181 @@
+"""
+asyncio wrappers that run PDFQuery's slow calls in an executor, so they don't
+block the event loop. Requires Python 3.5 or later.
+
+    >>> from pdfquery.aio import AsyncPDFQuery
+    >>> async with await AsyncPDFQuery.open("tests/samples/IRS_1040A.pdf") as pdf:
+    ...     await pdf.load(0)
+    ...     result = await pdf.extract([('with_formatter', 'text'),
+    ...                                 ('last_name', 'LTTextLineHorizontal:in_bbox("315,680,395,700")')])
+
+At most `concurrency` calls run at once in each process, however many
+documents are being handled; the rest wait their turn on the event loop.
+Set it before the first call.
+"""
+import asyncio
+import functools
+import multiprocessing
+import threading
+import weakref
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from .batch import _extract_document, _restore_result
+from .pdfquery import ExtractionPlan, PDFQuery, _flatten
+
+concurrency = multiprocessing.cpu_count()
+
+# pages per worker process in each executor call of AsyncPDFQuery.load()
+# for documents opened with workers > 1, so starting the pool is worth it
+pages_per_worker = 4
+
+_semaphores = weakref.WeakKeyDictionary()  # event loop -> asyncio.Semaphore
+_default_executor = None
+_default_executor_lock = threading.Lock()
+
+
+def _get_semaphore(loop):
+    semaphore = _semaphores.get(loop)
+    if semaphore is None:
+        semaphore = _semaphores[loop] = asyncio.Semaphore(concurrency)
+    return semaphore
+
+
+def _get_default_executor():
+    global _default_executor
+    with _default_executor_lock:
+        if _default_executor is None:
+            _default_executor = ThreadPoolExecutor(concurrency)
+        return _default_executor
+
+
+async def _run(executor, fn, *args, **kwargs):
+    """
+        Call fn in executor (a shared thread pool if None) once fewer than
+        `concurrency` calls are running. A call that has started can't be
+        interrupted, so if the caller is cancelled, fn still finishes and
+        its slot is only freed then.
+    """
+    loop = asyncio.get_event_loop()
+    semaphore = _get_semaphore(loop)
+    await semaphore.acquire()
+    try:
+        future = (executor or _get_default_executor()).submit(functools.partial(fn, *args, **kwargs))
+    except BaseException:
+        semaphore.release()
+        raise
+
+    def release(_):
+        try:
+            loop.call_soon_threadsafe(semaphore.release)
+        except RuntimeError:  # the loop has been closed
+            pass
+    future.add_done_callback(release)
+    return await asyncio.wrap_future(future)
+
+
+class AsyncPDFQuery(object):
+    """
+        Async facade for a PDFQuery. Create one with
+        ``await AsyncPDFQuery.open(file, executor=None, **kwargs)``, which
+        takes the same arguments as PDFQuery(). The wrapped PDFQuery is
+        available as .pdf, with .pdf.tree and .pdf.pq once loaded.
+
+        Calls for one document run one at a time, in a thread executor: the
+        PDFQuery lives in this process, so it can't be used from a process
+        pool. Use async_extract() to search documents in other processes.
+    """
+
+    def __init__(self, pdf, executor=None):
+        self.pdf = pdf
+        self.executor = executor
+        self._lock = threading.Lock()
+
+    @classmethod
+    async def open(cls, file, executor=None, **kwargs):
+        """ Open file with PDFQuery(file, **kwargs) in the executor. """
+        if isinstance(executor, ProcessPoolExecutor):
+            raise TypeError("AsyncPDFQuery needs a thread executor; use async_extract() with process executors.")
+        pdf = await _run(executor, PDFQuery, file, **kwargs)
+        return cls(pdf, executor)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    def _call(self, fn, *args, **kwargs):
+        return _run(self.executor, self._locked, fn, *args, **kwargs)
+
+    def _locked(self, fn, *args, **kwargs):
+        # a call left running by a cancelled task finishes before the next
+        # call for this document starts
+        with self._lock:
+            return fn(*args, **kwargs)
+
+    async def load(self, *page_numbers):
+        """
+            Like PDFQuery.load(), but pages are built a few at a time in
+            separate executor calls, so other tasks get a turn in between
+            and cancelling the load stops it before the next call. Each call
+            builds one page, or pages_per_worker pages per worker process if
+            the document was opened with workers > 1. .pdf.tree and .pdf.pq
+            are only replaced once every page has been built.
+
+            With lazy=True this only sets up the tree, and pages are built
+            by the extract() calls that need them. Queries made directly
+            with .pdf.pq build pages in the calling thread.
+        """
+        pdf = self.pdf
+        if pdf.lazy:
+            await self._call(pdf.load, *page_numbers)
+            return
+        if len(page_numbers) == 1 and page_numbers[0] is None:
+            page_numbers = []
+        else:
+            page_numbers = list(_flatten(page_numbers)) or \
+                list(range(len(await self._call(pdf._cached_pages))))
+        batch_size = pdf.workers * pages_per_worker if pdf.workers and pdf.workers > 1 else 1
+        pages = []
+        for i in range(0, len(page_numbers), batch_size):
+            pages += await self._call(pdf._get_pages, page_numbers[i:i + batch_size])
+        tree = await self._call(pdf.get_tree, None)
+        pdf._append_pages(tree.getroot(), pages)
+        pdf.tree = tree
+        pdf.pq = pdf.get_pyquery(tree)
+
+    async def extract(self, searches, tree=None, as_dict=True):
+        """ Like PDFQuery.extract(), loading the whole document first if
+        nothing has been loaded. """
+        if tree is None and self.pdf.tree is None:
+            await self.load()
+        return await self._call(self.pdf.extract, searches, tree, as_dict)
+
+    async def close(self):
+        """ Like PDFQuery.close(). """
+        await self._call(self.pdf.close)
+
+
+async def async_extract(file, searches, page_numbers=None, executor=None, **kwargs):
+    """
+        Open file, load page_numbers (or every page) and apply searches in a
+        single executor call, and return the result of extract(). Any other
+        keyword arguments are passed to PDFQuery().
+
+        executor can be a process pool, as long as file and searches can be
+        pickled (a path, and searches with formatter names such as 'text').
+        pyquery objects in results are then rebuilt from copies of the
+        matched elements, as with batch_extract().
+    """
+    # compile here, so bad selectors are reported without using a worker
+    plan = searches if isinstance(searches, ExtractionPlan) else ExtractionPlan(searches)
+    if isinstance(executor, ProcessPoolExecutor):
+        plan = searches
+    if page_numbers is not None:
+        page_numbers = list(page_numbers)
+    cache = kwargs.pop('parse_tree_cacher', None)
+    kwargs.setdefault('keep_layout', False)
+    path, result, error = await _run(executor, _extract_document, file, plan, page_numbers, cache, kwargs)
+    if error is not None:
+        raise error
+    return _restore_result(result)
@@ -0,0 +1,217 @@
+"""
+Apply one set of searches to many documents, spread over a pool of worker
+processes.
+"""
+import collections
+import multiprocessing
+import pickle
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+from lxml import etree
+from pyquery import PyQuery
+
+from .pdfquery import ExtractionPlan, PDFPyQuery, PDFQuery, parser, _translator
+
+
+class _SerializedElements(list):
+    """ Elements of a pyquery result as XML strings, so that they can be sent
+    back from a worker and rebuilt as a PDFPyQuery in the caller. """
+
+
+class _SerializedElementList(list):
+    """ A list of elements as XML strings, rebuilt as a list. """
+
+
+class _SerializedElement(bytes):
+    """ A single element as an XML string. """
+
+
+def _to_portable(value):
+    if isinstance(value, PyQuery):
+        return _SerializedElements(etree.tostring(el, with_tail=False) for el in value)
+    if isinstance(value, etree._Element):
+        return _SerializedElement(etree.tostring(value, with_tail=False))
+    if isinstance(value, (list, tuple)) and value and all(isinstance(el, etree._Element) for el in value):
+        return _SerializedElementList(etree.tostring(el, with_tail=False) for el in value)
+    return value
+
+
+def _from_portable(value):
+    if isinstance(value, _SerializedElements):
+        return PDFPyQuery([etree.fromstring(el, parser) for el in value], css_translator=_translator)
+    if isinstance(value, _SerializedElementList):
+        return [etree.fromstring(el, parser) for el in value]
+    if isinstance(value, _SerializedElement):
+        return etree.fromstring(value, parser)
+    return value
+
+
+def _portable_exception(e):
+    """ Return e, or a RuntimeError describing it if e can't be pickled. """
+    try:
+        pickle.dumps(e)
+        return e
+    except Exception:
+        return RuntimeError("%s: %s" % (type(e).__name__, e))
+
+
+def _extract_document(path, plan, page_numbers, cache, options):
+    """ Load the document at path and apply plan to it, returning
+    (path, result, None), or (path, None, exception) if anything fails. """
+    try:
+        with PDFQuery(path, parse_tree_cacher=cache, **options) as pdf:
+            if page_numbers is None:
+                pdf.load()
+            else:
+                pdf.load(page_numbers)
+            result = pdf.extract(plan)
+        result = dict((k, _to_portable(v)) for k, v in result.items())
+        # fail this document, rather than the pool sending results back, if
+        # a formatter returned something that can't be pickled
+        pickle.dumps(result)
+        return path, result, None
+    except Exception as e:
+        return path, None, _portable_exception(e)
+
+
+# set up in each worker process by _init_worker
+_worker_state = {}
+
+
+def _init_worker(searches, page_numbers, cache, options):
+    # compile the searches once per worker, for all of its documents
+    if not isinstance(searches, ExtractionPlan):
+        searches = ExtractionPlan(searches)
+    _worker_state.update(plan=searches, page_numbers=page_numbers, cache=cache, options=options)
+
+
+def _extract_in_worker(path):
+    state = _worker_state
+    return _extract_document(path, state['plan'], state['page_numbers'], state['cache'], state['options'])
+
+
+def batch_extract(paths, searches, workers=None, page_numbers=None, cache=None, max_tasks_per_child=None,
+                  **options):
+    """
+        Apply searches to each PDF in paths, using a pool of worker
+        processes (by default one per CPU), and return an iterator of
+        (path, result, error) tuples in the order documents finish.
+
+        result is what PDFQuery.extract() returns for the document, or None
+        if loading or searching it raised an exception, which is returned as
+        error instead of stopping the batch. pyquery objects, elements and
+        lists of elements in results are rebuilt from copies of the matched
+        elements, so they can be queried but have no parents or .layout.
+        Any other result has to be picklable, or the document fails.
+
+        searches is a list of searches or an ExtractionPlan, as for
+        PDFQuery.extract(). page_numbers limits which pages are loaded, cache
+        is a parse tree cacher shared by all documents, and any other keyword
+        arguments are passed to PDFQuery(). With workers=1 documents are
+        processed in this process.
+
+        A document that kills its worker process (a crash, or running out of
+        memory) gets a BrokenProcessPool error, and the other documents are
+        run again in new workers. max_tasks_per_child replaces each worker
+        after that many documents, to bound memory use (Python 3.11 and up).
+
+        >>> for path, result, error in batch_extract(paths, [
+        ...         ('with_formatter', 'text'),
+        ...         ('last_name', 'LTTextLineHorizontal:in_bbox("315,680,395,700")')], page_numbers=[0]):
+        ...     print(path, error or result['last_name'])
+
+        Worker processes get their own copies of searches and cache. If
+        processes are started with the 'spawn' method (the default on
+        Windows and macOS), both must be picklable, so use a list of searches
+        with named formatters such as 'text' rather than lambdas or a plan.
+    """
+    # compile here too, so bad selectors are reported before any work starts
+    plan = searches if isinstance(searches, ExtractionPlan) else ExtractionPlan(searches)
+    if page_numbers is not None:
+        page_numbers = list(page_numbers)
+    options.setdefault('keep_layout', False)
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    if workers <= 1:
+        results = (_extract_document(path, plan, page_numbers, cache, options) for path in paths)
+        return _restore_results(results)
+    pool_options = {}
+    if max_tasks_per_child:
+        pool_options['max_tasks_per_child'] = max_tasks_per_child
+    return _extract_in_pool(paths, searches, workers, page_numbers, cache, options, pool_options)
+
+
+def _extract_in_pool(paths, searches, workers, page_numbers, cache, options, pool_options):
+    paths = iter(paths)
+    # Documents that were running when a worker died. Any of them could
+    # have killed it, so each is run again on its own to find out which.
+    suspects = collections.deque()
+    executor = None
+    running = {}  # future -> (path, whether it's running on its own)
+    try:
+        while True:
+            if executor is None:
+                executor = ProcessPoolExecutor(workers, initializer=_init_worker,
+                                               initargs=(searches, page_numbers, cache, options), **pool_options)
+            if suspects:
+                if not running:
+                    path = suspects.popleft()
+                    running[executor.submit(_extract_in_worker, path)] = (path, True)
+            else:
+                # keep a few documents queued per worker, without reading
+                # all of paths up front
+                for path in paths:
+                    running[executor.submit(_extract_in_worker, path)] = (path, False)
+                    if len(running) >= workers * 2:
+                        break
+            if not running:
+                break
+
+            done = wait(running, return_when=FIRST_COMPLETED)[0]
+            broken = False
+            for future in done:
+                path, alone = running.pop(future)
+                try:
+                    result = future.result()
+                except BrokenProcessPool as e:
+                    broken = True
+                    if alone:
+                        yield path, None, e
+                    else:
+                        suspects.append(path)
+                    continue
+                yield _restore_result_item(result)
+            if broken:
+                # every other running document fails with the pool
+                for future in wait(running)[0]:
+                    path, alone = running.pop(future)
+                    try:
+                        result = future.result()
+                    except BrokenProcessPool:
+                        suspects.append(path)
+                        continue
+                    yield _restore_result_item(result)
+                executor.shutdown(wait=False)
+                executor = None
+    finally:
+        if executor is not None:
+            for future in running:
+                future.cancel()
+            executor.shutdown(wait=False)
+
+
+def _restore_results(results):
+    for item in results:
+        yield _restore_result_item(item)
+
+
+def _restore_result_item(item):
+    path, result, error = item
+    return path, _restore_result(result), error
+
+
+def _restore_result(result):
+    if result is not None:
+        result = dict((k, _from_portable(v)) for k, v in result.items())
+    return result
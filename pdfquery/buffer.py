@@ -0,0 +1,90 @@
+"""
+File objects over memory, so a document held in bytes or mapped from disk
+is read in place by the parser and hashed by caches in one pass.
+"""
+import io
+import mmap
+import os
+
+import six
+
+# objects PDFQuery() treats as the contents of a document rather than a path
+buffer_types = (bytearray, memoryview)
+
+
+def is_document_data(file):
+    """ Return True if file holds the contents of a document rather than
+    naming one. bytes (str on Python 2) can be either, so they count as
+    contents only if the %PDF header is near the start. """
+    if isinstance(file, buffer_types):
+        return True
+    return isinstance(file, six.binary_type) and b'%PDF' in file[:1024]
+
+
+class BufferFile(object):
+    """
+        Read-only binary file over a bytes-like object or mmap. read() copies
+        only the bytes asked for, and .view is the whole buffer, without a
+        copy, for anything that can take a buffer (such as hashlib).
+
+        file is the open file a mapping was made from, if any. It supplies
+        .name and fileno(), and is left for the caller to close.
+    """
+
+    def __init__(self, data, file=None):
+        self.data = data
+        self.view = memoryview(data)
+        if self.view.ndim != 1 or self.view.itemsize != 1:
+            # Python 2 memoryviews can't be cast, so copy those instead
+            self.view = self.view.cast('B') if hasattr(self.view, 'cast') else memoryview(self.view.tobytes())
+        self.file = file
+        self.name = getattr(file, 'name', None)
+        self.position = 0
+
+    @classmethod
+    def map(cls, file):
+        """ Memory-map the open file, or return None if it can't be mapped
+        (it isn't a real file, or is empty). """
+        try:
+            return cls(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ), file)
+        except (AttributeError, EnvironmentError, ValueError, TypeError):
+            return None
+
+    def read(self, size=-1):
+        if self.view is None:
+            raise ValueError("I/O operation on closed file.")
+        start = min(self.position, len(self.view))
+        end = len(self.view) if size is None or size < 0 else min(start + size, len(self.view))
+        self.position = end
+        return self.view[start:end].tobytes()
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence == os.SEEK_END:
+            offset += len(self.view)
+        if offset < 0:
+            raise ValueError("negative seek position %s" % offset)
+        self.position = offset
+        return offset
+
+    @property
+    def closed(self):
+        return self.view is None
+
+    def tell(self):
+        return self.position
+
+    def fileno(self):
+        if self.file is None:
+            raise io.UnsupportedOperation("fileno")
+        return self.file.fileno()
+
+    def close(self):
+        """ Release the buffer, unmapping it if it was mapped. """
+        if self.view is not None:
+            if hasattr(self.view, 'release'):  # Python 3
+                self.view.release()
+            self.view = None
+            if isinstance(self.data, mmap.mmap):
+                self.data.close()
@@ -1,28 +1,175 @@
 import hashlib
-import zipfile
+import os
+import struct
+import tempfile
+import threading
+import time
+import zlib
+from collections import OrderedDict
 from lxml import etree
 
-class BaseCache(object):
+from .buffer import BufferFile
+
+# optional faster compression
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+# Part of every parse tree cache key, and of every serialized tree. Bump this
+# whenever a change to pdfquery changes the trees it builds or the way caches
+# store them, so that trees cached by older versions are never served.
+CACHE_FORMAT_VERSION = 2
+
+
+# serialized tree format: magic, format version, codec id, then the tree as
+# (possibly compressed) utf-8 XML. Rebuilding elements from a custom record
+# format in Python benchmarked about three times slower than letting libxml2
+# parse XML, so the savings come from skipping zip and picking fast codecs.
+_header = struct.Struct('4sBB')
+_magic = b'PDFQ'
+_codecs = OrderedDict()
+if zstandard:
+    _codecs['zstd'] = (3, lambda data: zstandard.ZstdCompressor(level=1).compress(data),
+                       lambda data: zstandard.ZstdDecompressor().decompress(data))
+if lz4:
+    _codecs['lz4'] = (2, lz4.frame.compress, lz4.frame.decompress)
+_codecs['zlib'] = (1, lambda data: zlib.compress(data, 1), zlib.decompress)
+_codecs[None] = (0, lambda data: data, lambda data: data)
+_codecs_by_id = dict((codec[0], codec) for codec in _codecs.values())
+
+# what reading a truncated or corrupted cache file can raise
+_corrupt_data_errors = (ValueError, struct.error, zlib.error, etree.XMLSyntaxError)
+if zstandard:
+    _corrupt_data_errors += (zstandard.ZstdError,)
+if lz4:
+    _corrupt_data_errors += (RuntimeError,)  # lz4.frame reports bad data this way
+
+
+def serialize_tree(tree, codec='auto'):
+    """
+        Serialize element or tree to bytes. codec can be 'zstd' or 'lz4' (if
+        those packages are installed), 'zlib', None for no compression, or
+        'auto' for the fastest one available.
+    """
+    if codec == 'auto':
+        codec = next(iter(_codecs))
+    try:
+        codec_id, compress, decompress = _codecs[codec]
+    except KeyError:
+        raise ValueError("Compression codec %r is not available." % (codec,))
+    xml = etree.tostring(tree, encoding='utf-8')
+    return _header.pack(_magic, CACHE_FORMAT_VERSION, codec_id) + compress(xml)
+
+
+def deserialize_tree(data):
+    """
+        Return lxml.etree.ElementTree of LayoutElements for a tree serialized
+        by serialize_tree(). Raises ValueError if data isn't in the current
+        format.
+    """
+    from .pdfquery import parser  # pdfquery imports this module
+    magic, version, codec_id = _header.unpack_from(data)
+    if magic != _magic or version != CACHE_FORMAT_VERSION or codec_id not in _codecs_by_id:
+        raise ValueError("Not a serialized tree in the current cache format.")
+    root = etree.fromstring(_codecs_by_id[codec_id][2](data[_header.size:]), parser)
+    return etree.ElementTree(root)
+
+
+class CacheStats(object):
+    """
+        Counters kept by cache backends: lookups that hit and missed, entries
+        evicted to stay within size limits or because they expired, the
+        number of bytes the cache currently holds (for backends that track
+        it) and the number of bytes of serialized trees written so far.
+    """
 
     def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes = 0
+        self.bytes_written = 0
+
+    def as_dict(self):
+        return dict(hits=self.hits, misses=self.misses, evictions=self.evictions,
+                    bytes=self.bytes, bytes_written=self.bytes_written)
+
+    def __repr__(self):
+        return ("<CacheStats hits=%(hits)s misses=%(misses)s evictions=%(evictions)s "
+                "bytes=%(bytes)s bytes_written=%(bytes_written)s>" % self.as_dict())
+
+
+class BaseCache(object):
+
+    # bytes read from each end of the file by file_identity='fast'
+    fast_identity_sample_size = 65536
+
+    def __init__(self, file_identity='md5'):
+        """
+            file_identity controls how file_key() identifies files:
+            'md5' hashes the whole file; 'fast' combines its size,
+            modification time and a hash of its first and last
+            fast_identity_sample_size bytes, which is much cheaper for large
+            files but can miss edits that keep size, mtime and both ends the
+            same.
+        """
+        if file_identity not in ('md5', 'fast'):
+            raise ValueError("file_identity must be 'md5' or 'fast'.")
+        self.file_identity = file_identity
         self.hash_key = None
+        self.stats = CacheStats()
 
     def set_hash_key(self, file):
         """Calculate and store hash key for file."""
+        self.hash_key = self.file_key(file)
+
+    def file_key(self, file):
+        """
+            Return the hash key for file without storing it. PDFQuery uses
+            this and passes the key to get() and set(), so one cache can be
+            shared by documents loading at the same time.
+        """
         filehasher = hashlib.md5()
-        while True:
-            data = file.read(8192)
-            if not data:
-                break
-            filehasher.update(data)
+        if self.file_identity == 'fast':
+            file.seek(0, os.SEEK_END)
+            size = file.tell()
+            try:
+                mtime = os.fstat(file.fileno()).st_mtime
+            except (AttributeError, OSError, ValueError):
+                # not a real file, e.g. BytesIO
+                mtime = None
+            filehasher.update(repr((size, mtime)).encode('utf8'))
+            file.seek(0)
+            filehasher.update(file.read(self.fast_identity_sample_size))
+            file.seek(max(0, size - self.fast_identity_sample_size))
+            filehasher.update(file.read(self.fast_identity_sample_size))
+        elif isinstance(file, BufferFile):
+            # already in memory, so hash it in place
+            filehasher.update(file.view)
+        else:
+            file.seek(0)
+            while True:
+                data = file.read(8192)
+                if not data:
+                    break
+                filehasher.update(data)
         file.seek(0)
-        self.hash_key = filehasher.hexdigest()
+        return filehasher.hexdigest()
+
+    def _hash_key(self, hash_key):
+        return self.hash_key if hash_key is None else hash_key
 
-    def set(self, page_range_key, tree):
-        """write tree to key"""
+    def set(self, page_range_key, tree, hash_key=None):
+        """write tree to key, for the file with hash_key (by default the
+        one stored by set_hash_key())"""
         pass
 
-    def get(self, page_range_key):
+    def get(self, page_range_key, hash_key=None):
         """load tree from key, or None if cache miss"""
         return None
 
@@ -33,29 +180,195 @@ class DummyCache(BaseCache):
 
 class FileCache(BaseCache):
 
-    def __init__(self, directory='/tmp/'):
+    def __init__(self, directory='/tmp/', file_identity='md5', codec='auto'):
+        """ codec is the compression used for cache files; see serialize_tree(). """
         self.directory = directory
-        super(FileCache, self).__init__()
+        self.codec = codec
+        super(FileCache, self).__init__(file_identity)
 
-    def get_cache_filename(self, page_range_key):
-        return "pdfquery_{hash_key}{page_range_key}.xml".format(
-            hash_key=self.hash_key,
+    def get_cache_filename(self, page_range_key, hash_key=None):
+        return "pdfquery_{hash_key}{page_range_key}.pdfq".format(
+            hash_key=self._hash_key(hash_key),
             page_range_key=page_range_key
         )
 
-    def get_cache_file(self, page_range_key, mode):
+    def get_cache_path(self, page_range_key, hash_key=None):
+        return self.directory+self.get_cache_filename(page_range_key, hash_key)
+
+    def set(self, page_range_key, tree, hash_key=None):
+        # write to a temporary file and rename it into place, so other
+        # threads and processes never read a partly written file
+        path = self.get_cache_path(page_range_key, hash_key)
+        data = serialize_tree(tree, self.codec)
+        fd, temp_path = tempfile.mkstemp(
+            suffix='.tmp', prefix=os.path.basename(path) + '.', dir=os.path.dirname(path) or os.curdir)
+        try:
+            with os.fdopen(fd, 'wb') as cache_file:
+                cache_file.write(data)
+            getattr(os, 'replace', os.rename)(temp_path, path)
+        except BaseException:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            raise
+        self.stats.bytes_written += len(data)
+
+    def get(self, page_range_key, hash_key=None):
         try:
-            return zipfile.ZipFile(self.directory+self.get_cache_filename(page_range_key)+".zip", mode)
-        except IOError:
+            with open(self.get_cache_path(page_range_key, hash_key), 'rb') as cache_file:
+                tree = deserialize_tree(cache_file.read())
+        except (IOError,) + _corrupt_data_errors:
+            self.stats.misses += 1
             return None
+        self.stats.hits += 1
+        return tree
+
+
+class LRUFileCache(FileCache):
+    """
+        FileCache that keeps the files it uses under max_bytes by deleting the
+        least recently used ones, and treats files unused for more than ttl
+        seconds as expired. Either limit can be None.
+
+        Cache files (pdfquery_*.pdfq) already in the directory are indexed
+        when the cache is created, oldest modification time first, so files
+        from earlier runs count towards max_bytes and get evicted. After
+        that the index is kept in memory, so writes never rescan the
+        directory, and other files in it are left alone. Files that other
+        processes write later are counted once this cache reads them, so
+        processes sharing a directory can together hold up to max_bytes
+        each. Lookups check and refresh modification times, so ttl applies
+        across processes.
+    """
+
+    def __init__(self, directory='/tmp/', max_bytes=None, ttl=None, file_identity='md5', codec='auto'):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._files = OrderedDict()  # path -> (size, last use), least recently used first
+        self._lock = threading.Lock()
+        super(LRUFileCache, self).__init__(directory, file_identity, codec)
+        self._index_directory()
+        self.evict()
+
+    def _index_directory(self):
+        """ Add the cache files already in the directory to the index. """
+        try:
+            names = os.listdir(self.directory or os.curdir)
+        except OSError:
+            return
+        found = []
+        for name in names:
+            if name.startswith('pdfquery_') and name.endswith('.pdfq'):
+                path = self.directory + name
+                try:
+                    found.append((os.path.getmtime(path), os.path.getsize(path), path))
+                except OSError:
+                    continue
+        found.sort()
+        for mtime, size, path in found:
+            self._files[path] = (size, mtime)
+            self.stats.bytes += size
+
+    def _expired(self, mtime, now):
+        return self.ttl is not None and now - mtime > self.ttl
+
+    def _track(self, path):
+        """ Record path as just used. """
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return
+        with self._lock:
+            old = self._files.pop(path, None)
+            if old is not None:
+                self.stats.bytes -= old[0]
+            self._files[path] = (size, time.time())
+            self.stats.bytes += size
+
+    def _untrack(self, path):
+        with self._lock:
+            old = self._files.pop(path, None)
+            if old is not None:
+                self.stats.bytes -= old[0]
+
+    def set(self, page_range_key, tree, hash_key=None):
+        super(LRUFileCache, self).set(page_range_key, tree, hash_key)
+        self._track(self.get_cache_path(page_range_key, hash_key))
+        self.evict()
+
+    def get(self, page_range_key, hash_key=None):
+        path = self.get_cache_path(page_range_key, hash_key)
+        try:
+            if self._expired(os.path.getmtime(path), time.time()):
+                os.remove(path)
+                self._untrack(path)
+                self.stats.evictions += 1
+            else:
+                os.utime(path, None)  # mark as recently used
+        except OSError:
+            pass
+        tree = super(LRUFileCache, self).get(page_range_key, hash_key)
+        if tree is not None:
+            self._track(path)
+        return tree
+
+    def evict(self):
+        """ Delete this cache's expired files, then its least recently used
+        ones until they are within max_bytes. """
+        now = time.time()
+        with self._lock:
+            while self._files:
+                path, (size, used) = next(iter(self._files.items()))
+                if not self._expired(used, now) and (self.max_bytes is None or self.stats.bytes <= self.max_bytes):
+                    break
+                del self._files[path]
+                self.stats.bytes -= size
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue  # removed by another process
+                self.stats.evictions += 1
+
+
+class MemoryLRUCache(BaseCache):
+    """
+        In-memory cache holding serialized trees, evicting the least recently
+        used ones to stay within max_bytes and max_entries. Either limit can
+        be None. Trees are stored uncompressed unless a codec is given; see
+        serialize_tree().
+    """
+
+    def __init__(self, max_bytes=None, max_entries=None, file_identity='md5', codec=None):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.codec = codec
+        self.entries = OrderedDict()
+        self._lock = threading.Lock()
+        super(MemoryLRUCache, self).__init__(file_identity)
 
-    def set(self, page_range_key, tree):
-        xml = etree.tostring(tree, encoding='utf-8', pretty_print=False, xml_declaration=True)
-        cache_file = self.get_cache_file(page_range_key, 'w')
-        cache_file.writestr(self.get_cache_filename(page_range_key), xml)
-        cache_file.close()
+    def set(self, page_range_key, tree, hash_key=None):
+        key = (self._hash_key(hash_key), page_range_key)
+        data = serialize_tree(tree, self.codec)
+        with self._lock:
+            if key in self.entries:
+                self.stats.bytes -= len(self.entries.pop(key))
+            self.entries[key] = data
+            self.stats.bytes += len(data)
+            self.stats.bytes_written += len(data)
+            while self.entries and (
+                    (self.max_bytes is not None and self.stats.bytes > self.max_bytes) or
+                    (self.max_entries is not None and len(self.entries) > self.max_entries)):
+                self.stats.bytes -= len(self.entries.popitem(last=False)[1])
+                self.stats.evictions += 1
 
-    def get(self, page_range_key):
-        cache_file = self.get_cache_file(page_range_key, 'r')
-        if cache_file:
-            return etree.fromstring(cache_file.read(self.get_cache_filename(page_range_key)))
\ No newline at end of file
+    def get(self, page_range_key, hash_key=None):
+        key = (self._hash_key(hash_key), page_range_key)
+        with self._lock:
+            data = self.entries.pop(key, None)
+            if data is None:
+                self.stats.misses += 1
+                return None
+            self.entries[key] = data  # mark as recently used
+            self.stats.hits += 1
+        return deserialize_tree(data)
@@ -3,9 +3,14 @@ from __future__ import print_function
 
 # builtins
 import codecs
+import hashlib
 import json
+import multiprocessing
 import numbers
+from operator import itemgetter
+import os
 import re
+import threading
 import chardet
 try:
     from collections import OrderedDict
@@ -23,7 +28,7 @@ except ImportError:
     from pdfminer.pdfdocument import PDFDocument
     from pdfminer.pdfpage import PDFPage
 from pdfminer.pdfinterp import PDFResourceManager, PDFPageInterpreter
-from pdfminer.layout import LAParams, LTChar, LTImage, LTPage
+from pdfminer.layout import LAParams, LTAnno, LTChar, LTImage, LTPage, LTTextLine
 from pdfminer.converter import PDFPageAggregator
 from pdfminer.pdftypes import resolve1
 
@@ -37,11 +42,17 @@ from six.moves import zip
 
 # local imports
 from .pdftranslator import PDFQueryTranslator
-from .cache import DummyCache
+from .buffer import BufferFile, is_document_data
+from .cache import CacheStats, DummyCache, CACHE_FORMAT_VERSION
+from .spatial import GeometryTable, bbox_index, element_bbox, invalidate_bbox_indexes, nest_by_bbox, nest_indexes, \
+    page_geometry, _xpath_bbox
+from .stats import timer
 
 
 # Re-sort the PDFMiner Layout tree so elements that fit inside other elements
-# will be children of them
+# will be children of them.
+# PDFQuery uses spatial.nest_by_bbox(), which builds the same tree in one pass;
+# this incremental version is kept as the reference implementation.
 def _append_sorted(root, el, comparator):
     """ Add el as a child of root, or as a child of one of root's children.
     Comparator is a function(a, b) returning > 0 if a is a child of b, < 0 if
@@ -111,6 +122,14 @@ bom_headers = set([
 ])
 
 
+# Memo of strings decoded with chardet, most recently used last. Only
+# strings up to decode_cache_max_length bytes are kept.
+decode_cache_size = 4096
+decode_cache_max_length = 1024
+_decode_cache = OrderedDict()
+_decode_cache_lock = threading.Lock()
+
+
 def smart_unicode_decode(encoded_string):
     """
         Given an encoded string of unknown format, detect the format with
@@ -128,6 +147,29 @@ def smart_unicode_decode(encoded_string):
     except UnicodeDecodeError:
         pass
 
+    # PDF text strings with a byte order mark, which is all chardet would
+    # look at for them
+    if encoded_string.startswith(codecs.BOM_UTF16_BE):
+        return _strip_bom(encoded_string[2:].decode('utf-16-be', 'replace'))
+    if encoded_string.startswith(codecs.BOM_UTF8):
+        return _strip_bom(encoded_string[3:].decode('utf8', 'replace'))
+
+    if len(encoded_string) > decode_cache_max_length or type(encoded_string) != six.binary_type:
+        return _chardet_decode(encoded_string)
+    with _decode_cache_lock:
+        decoded_string = _decode_cache.pop(encoded_string, None)
+        if decoded_string is not None:
+            _decode_cache[encoded_string] = decoded_string  # mark as recently used
+            return decoded_string
+    decoded_string = _chardet_decode(encoded_string)
+    with _decode_cache_lock:
+        _decode_cache[encoded_string] = decoded_string
+        while len(_decode_cache) > decode_cache_size:
+            _decode_cache.popitem(last=False)
+    return decoded_string
+
+
+def _chardet_decode(encoded_string):
     # detect encoding
     detected_encoding = chardet.detect(encoded_string)
     # bug 54 -- depending on chardet version, if encoding is not guessed,
@@ -140,11 +182,15 @@ def smart_unicode_decode(encoded_string):
     )
 
     # unicode string may still have useless BOM character at the beginning
+    return _strip_bom(decoded_string)
+
+
+def _strip_bom(decoded_string):
     if decoded_string and decoded_string[0] in bom_headers:
         decoded_string = decoded_string[1:]
-
     return decoded_string
 
+
 def prepare_for_json_encoding(obj):
     """
     Convert an arbitrary object into just JSON data types (list, dict, unicode str, int, bool, null).
@@ -171,18 +217,86 @@ def obj_to_string(obj, top=True):
     """
     Turn an arbitrary object into a unicode string. If complex (dict/list/tuple), will be json-encoded.
     """
+    # fast paths for the common simple values
+    obj_type = type(obj)
+    if obj_type == six.text_type:
+        return obj
+    if obj_type == six.binary_type:
+        return smart_unicode_decode(obj)
+    if obj_type == int:
+        return str(obj)
     obj = prepare_for_json_encoding(obj)
     if type(obj) == six.text_type:
         return obj
     return json.dumps(obj)
 
 
+def _fingerprint(*values):
+    """ Return a short stable hash of the reprs of values. """
+    return hashlib.md5(repr(values).encode('utf8')).hexdigest()[:16]
+
+
+def _callable_fingerprint(func):
+    """
+        Identify a function by name, bytecode, constants and closure values,
+        so that changing a lambda's code also changes its fingerprint.
+        Anything without a stable repr just makes the fingerprint unstable,
+        which costs cache hits rather than returning wrong results.
+    """
+    code = getattr(func, '__code__', None)
+    if code is None:
+        return repr(func)
+    return (
+        getattr(func, '__module__', None),
+        getattr(func, '__qualname__', func.__name__),
+        code.co_code,
+        [getattr(const, 'co_code', const) for const in code.co_consts],
+        [repr(cell.cell_contents) for cell in func.__closure__ or ()],
+    )
+
+
 # via http://stackoverflow.com/a/25920392/307769
 invalid_xml_chars_re = re.compile(u'[^\u0020-\uD7FF\u0009\u000A\u000D\uE000-\uFFFD\u10000-\u10FFFF]+')
 def strip_invalid_xml_chars(s):
     return invalid_xml_chars_re.sub(r'', s)
 
 
+_unplaced_sort_key = (1, 0.0, 0.0)
+def _sort_lines(keyed, tolerance):
+    """ Given (sort key, element) pairs sorted top to bottom, group elements
+    into lines whose tops are within tolerance of the line's first element,
+    and sort each line left to right. """
+    lines = []
+    line_top = None
+    for key, child in keyed:
+        if key is _unplaced_sort_key:
+            lines.append([(key, child)])
+            line_top = None
+        elif line_top is not None and -key[1] >= line_top - tolerance:
+            lines[-1].append((key, child))
+        else:
+            lines.append([(key, child)])
+            line_top = -key[1]
+    result = []
+    for line in lines:
+        line.sort(key=lambda pair: pair[0][2])
+        result += line
+    return result
+
+
+def _build_pages_in_worker(task):
+    """ Build the given pages of a document in a worker process, and return
+    them as serialized LTPage elements. Text cleaning is left to the caller,
+    so input_text_formatter never has to be sent to the worker. """
+    (kind, source), options, page_numbers, pageno = task
+    if kind == 'data':
+        source = six.BytesIO(source)
+    pdf = PDFQuery(source, keep_layout=False, **options)
+    pdf.device.pageno = pageno
+    return [etree.tostring(pdf._build_page(n, pdf.get_layout(n)), encoding='utf-8')
+            for n in page_numbers]
+
+
 # custom PDFDocument class
 class QPDFDocument(PDFDocument):
     def get_page_number(self, index):
@@ -282,17 +396,316 @@ class LayoutElement(etree.ElementBase):
     @property
     def layout(self):
         if not hasattr(self, '_layout'):
+            # Elements restored from the parse tree cache or built by
+            # workers have no layout yet; let the PDFQuery that built the
+            # tree load it, if it can.
             self._layout = None
+            load_layouts = getattr(self.getroottree().getroot(), '_load_layouts', None)
+            if load_layouts:
+                load_layouts(self)
         return self._layout
 
     @layout.setter
     def layout(self, value):
         self._layout = value
+
+    @property
+    def bbox(self):
+        """ (x0, y0, x1, y1) as floats, or None if the element has no
+        position. Taken from the page's geometry table if the page was built
+        in this process, otherwise parsed from the element's attributes. """
+        geometry = page_geometry(self)
+        bbox = geometry and geometry.get(self)
+        return element_bbox(self) if bbox is None else bbox
 parser_lookup = etree.ElementDefaultClassLookup(element=LayoutElement)
 parser = etree.XMLParser()
 parser.set_element_class_lookup(parser_lookup)
 
 
+_bbox_selector_re = re.compile(
+    r'''^\s*(\*|[A-Za-z_][\w-]*)?:(in_bbox|overlaps_bbox)\(\s*(["'])([^"']*)\3\s*\)\s*$''')
+def _parse_bbox_selector(selector):
+    """
+        If selector is a single :in_bbox() or :overlaps_bbox(), optionally
+        with a tag name, return (tag or None, bbox, overlap). Otherwise
+        return None.
+    """
+    match = _bbox_selector_re.match(selector)
+    if not match:
+        return None
+    tag, function, quote, bbox = match.groups()
+    try:
+        x0, y0, x1, y1 = map(float, bbox.split(","))
+    except ValueError:
+        return None
+    return None if tag in (None, '*') else tag, (x0, y0, x1, y1), function == 'overlaps_bbox'
+
+
+def _indexed_pages(contexts):
+    """
+        Return the pages to search with spatial indexes for a bbox selector
+        applied to contexts, or None if the selector has to be run as XPath.
+    """
+    # Only pages and the document root have indexes. The root has no bbox,
+    # so it never matches itself.
+    pages = []
+    for context in contexts:
+        context_tag = getattr(context, 'tag', None)
+        if context_tag == 'LTPage':
+            pages.append(context)
+        elif isinstance(context_tag, six.string_types) and _xpath_bbox(context) is None and \
+                all(child.tag == 'LTPage' for child in context):
+            pages.extend(context)
+        else:
+            return None
+    return pages
+
+
+def _select_bbox(bbox_selector, pages):
+    """ Return elements matching a parsed bbox selector on pages. """
+    tag, bbox, overlap = bbox_selector
+    elements = []
+    for page in pages:
+        elements += bbox_index(page).query(*bbox, tags=tag, overlap=overlap)
+    return elements
+
+
+# attributes every element with a position gets, whatever the attributes option
+_bbox_attributes = frozenset(['x0', 'y0', 'x1', 'y1'])
+# values _value_to_string() can build json for item by item
+_number_list_types = (float, int, tuple, list)
+
+# translators don't keep any state, so one is shared by every query
+_translator = PDFQueryTranslator()
+
+
+def _page_scopes(selector):
+    """
+        Return XPath expressions that find, from the document root, every
+        page a selector can match or descend into, or None if it could need
+        any page. Only selectors that start with LTPage and attribute
+        conditions, alone or followed by a descendant or child combinator,
+        are limited to some pages.
+    """
+    scopes = []
+    for parsed in cssselect.parse(selector.replace('[@', '[')):
+        tree = parsed.parsed_tree
+        combinator = None
+        while isinstance(tree, cssselect.parser.CombinedSelector):
+            combinator = tree.combinator
+            tree = tree.selector
+        compound = tree
+        while isinstance(compound, cssselect.parser.Attrib):
+            compound = compound.selector
+        if combinator not in (None, ' ', '>') or parsed.pseudo_element or \
+                not isinstance(compound, cssselect.parser.Element) or compound.element != 'LTPage':
+            return None
+        scopes.append(etree.XPath('descendant-or-self::%s' % _translator.xpath(tree)))
+    return scopes
+
+
+class PDFPyQuery(PyQuery):
+    """
+        PyQuery that runs selectors through compile(), so each selector is
+        translated to XPath once per process, and answers selectors made of a
+        single :in_bbox() or :overlaps_bbox() from a spatial index of each
+        page instead of checking every element. Results are the same as for
+        PyQuery.
+    """
+
+    def __call__(self, *args, **kwargs):
+        if len(args) == 1 and not kwargs and self.namespaces is None and \
+                isinstance(args[0], six.string_types) and args[0] and not args[0].startswith('<'):
+            return compile(args[0]).select(self)
+        return super(PDFPyQuery, self).__call__(*args, **kwargs)
+
+
+class CompiledSelector(object):
+    """
+        A selector translated to XPath and compiled once. Call it with a
+        tree, element, list of elements or pyquery object to get the same
+        pyquery result as selecting from that object with pdf.pq.
+        Use compile() to get one.
+    """
+
+    def __init__(self, selector):
+        self.selector = selector
+        self.bbox_selector = _parse_bbox_selector(selector)
+        # same translation as PyQuery._css_to_xpath()
+        self.xpath = etree.XPath(_translator.css_to_xpath(
+            selector.replace('[@', '['), 'descendant-or-self::'))
+        self._page_scopes = False  # worked out if used on a lazy tree
+
+    def __repr__(self):
+        return "<CompiledSelector %r>" % self.selector
+
+    def __call__(self, tree):
+        if hasattr(tree, 'getroot'):
+            tree = tree.getroot()
+        if not isinstance(tree, PDFPyQuery):
+            tree = PDFPyQuery(tree, css_translator=_translator)
+        return self.select(tree)
+
+    def select(self, context, pages=None):
+        """ Apply to a PDFPyQuery. pages, if given, are _indexed_pages(context).
+        If the tree was built with stats, the time taken is recorded as the
+        'query' stage. """
+        self._load_lazy_pages(context)
+        stats = _tree_stats(context)
+        if stats is None:
+            return self._select(context, pages)
+        start = timer()
+        result = self._select(context, pages)
+        stats.record_time('query', None, timer() - start)
+        return result
+
+    def _select(self, context, pages):
+        if self.bbox_selector:
+            if pages is None:
+                pages = _indexed_pages(context)
+            if pages is not None:
+                return context._copy(_select_bbox(self.bbox_selector, pages), parent=context)
+        elements = []
+        for el in context:
+            elements.extend(self.xpath(el))
+        return context._copy(elements, parent=context)
+
+    def _load_lazy_pages(self, context):
+        """ If context is in a lazy tree, build the placeholder pages this
+        selector could match or descend into. """
+        for el in context:
+            if not isinstance(el, etree._Element):
+                continue
+            root = el.getroottree().getroot()
+            placeholders = getattr(root, '_placeholders', None)
+            if not placeholders:
+                continue
+            if el in placeholders:
+                pages = [el]
+            elif el.getparent() is None:
+                if self._page_scopes is False:
+                    self._page_scopes = _page_scopes(self.selector)
+                if self._page_scopes is None:
+                    pages = list(placeholders)
+                else:
+                    pages = [page for scope in self._page_scopes for page in scope(el)]
+            else:
+                continue
+            root._load_placeholders(pages)
+
+
+def _tree_stats(context):
+    """ Return the PDFQueryStats of the tree context's elements are in, if
+    any. """
+    for el in context:
+        if isinstance(el, etree._Element):
+            return getattr(el.getroottree().getroot(), '_stats', None)
+    return None
+
+
+# Process-wide memo of compiled selectors, most recently used last.
+selector_cache_size = 1024
+selector_cache_stats = CacheStats()
+_selector_cache = OrderedDict()
+_selector_cache_lock = threading.Lock()
+
+
+def compile(selector):
+    """
+        Return a CompiledSelector for selector, which can be applied to any
+        loaded tree:
+
+        >>> last_name = pdfquery.compile('LTTextLineHorizontal:in_bbox("315,680,395,700")')
+        >>> last_name(pdf.tree).text()
+        'Michaels'
+
+        Compiled selectors are shared by every document and PDFQuery in the
+        process; the selector_cache_size most recently used are kept.
+        selector_cache_stats counts hits, misses and evictions.
+    """
+    with _selector_cache_lock:
+        compiled = _selector_cache.pop(selector, None)
+        if compiled is not None:
+            _selector_cache[selector] = compiled  # mark as recently used
+            selector_cache_stats.hits += 1
+            return compiled
+        selector_cache_stats.misses += 1
+
+    compiled = CompiledSelector(selector)
+    with _selector_cache_lock:
+        _selector_cache[selector] = compiled
+        while len(_selector_cache) > selector_cache_size:
+            _selector_cache.popitem(last=False)
+            selector_cache_stats.evictions += 1
+    return compiled
+
+
+class ExtractionPlan(object):
+    """
+        A list of searches for PDFQuery.extract(), with every selector
+        compiled up front with compile(). Pass a plan to extract() or
+        iter_pages() in place of the list to reuse it across calls and
+        documents:
+
+        >>> plan = ExtractionPlan([('last_name', 'LTTextLineHorizontal:in_bbox("315,680,395,700")')])
+        >>> pdf.extract(plan)
+    """
+
+    def __init__(self, searches):
+        self.steps = []
+        formatter = None
+        for search in searches:
+            if len(search) < 3:
+                search = list(search) + [formatter]
+            key, search, tmp_formatter = search
+            if key == 'with_formatter':
+                if isinstance(search, six.string_types):
+                    # is a pyquery method name, e.g. 'text'
+                    formatter = lambda o, search=search: getattr(o, search)()
+                elif hasattr(search, '__call__') or not search:
+                    # is a method, or None to end formatting
+                    formatter = search
+                else:
+                    raise TypeError("Formatter should be either a pyquery "
+                                    "method name or a callable function.")
+            elif key == 'with_parent':
+                self.steps.append((key, compile(search) if search else None, None))
+            elif hasattr(search, '__call__'):
+                self.steps.append((key, search, tmp_formatter))
+            else:
+                try:
+                    selector = compile(search)
+                except cssselect.SelectorSyntaxError as e:
+                    raise cssselect.SelectorSyntaxError(
+                        "Error applying selector '%s': %s" % (search, e))
+                self.steps.append((key, selector, tmp_formatter))
+
+    def extract(self, pq, as_dict=True):
+        """ Run the searches against a PDFPyQuery; see PDFQuery.extract(). """
+        results = []
+        # pages are found once for all the bbox fields under each parent
+        parent = pq
+        parent_pages = pages = _indexed_pages(pq)
+        for key, search, formatter in self.steps:
+            if key == 'with_parent':
+                if search:
+                    parent = search.select(pq, pages)
+                    parent_pages = _indexed_pages(parent)
+                else:
+                    parent, parent_pages = pq, pages
+            else:
+                if isinstance(search, CompiledSelector):
+                    result = search.select(parent, parent_pages)
+                else:
+                    result = parent("*").filter(search)
+                if formatter:
+                    result = formatter(result)
+                results += result if type(result) == tuple else [[key, result]]
+        if as_dict:
+            results = dict(results)
+        return results
+
+
 # main class
 class PDFQuery(object):
     def __init__(
@@ -306,29 +719,69 @@ class PDFQuery(object):
             resort=True,
             parse_tree_cacher=None,
             laparams={'all_texts':True, 'detect_vertical':True},
-            password=''
+            password='',
+            workers=None,
+            char_level='merge',
+            attributes=None,
+            sort_tolerance=0,
+            keep_layout=True,
+            lazy=False,
+            stats=None,
+            memory_map=False
     ):
         # store input
+        if char_level not in ('merge', 'drop', 'full'):
+            raise ValueError("char_level must be 'merge', 'drop' or 'full'.")
+        if attributes is not None:
+            attributes = frozenset(attributes) | _bbox_attributes
         self.merge_tags = merge_tags
         self.round_floats = round_floats
         self.round_digits = round_digits
         self.resort = resort
+        self.workers = workers
+        self.char_level = char_level
+        self.attributes = attributes
+        self.sort_tolerance = sort_tolerance
+        self.keep_layout = keep_layout
+        self.lazy = lazy
+        self.stats = stats
+        self._attribute_names = {}  # layout class -> attributes to copy
+
+        # options needed to rebuild pages the same way in worker processes
+        self._worker_options = dict(
+            merge_tags=merge_tags,
+            round_floats=round_floats,
+            round_digits=round_digits,
+            resort=resort,
+            laparams=laparams,
+            password=password,
+            char_level=char_level,
+            attributes=attributes,
+            sort_tolerance=sort_tolerance,
+            memory_map=memory_map,
+        )
 
         # set up input text formatting function, if any
         if input_text_formatter:
             self.input_text_formatter = input_text_formatter
         elif normalize_spaces:
             r = re.compile(r'\s+')
-            self.input_text_formatter = lambda s: re.sub(r, ' ', s)
+            self.input_text_formatter = lambda s: r.sub(' ', s)
         else:
             self.input_text_formatter = None
 
         # open doc
-        if not hasattr(file, 'read'):
+        document_data = is_document_data(file)
+        self._owns_file = not hasattr(file, 'read') and not document_data
+        if self._owns_file:
             try:
                 file = open(file, 'rb')
             except TypeError:
-                raise TypeError("File must be file object or filepath string.")
+                raise TypeError("File must be file object, filepath string or bytes-like object.")
+        if document_data:
+            file = BufferFile(file)
+        elif memory_map:
+            file = BufferFile.map(file) or file
 
         parser = PDFParser(file)
         if hasattr(QPDFDocument, 'set_parser'):
@@ -350,11 +803,14 @@ class PDFQuery(object):
         self.pq = None
         self.file = file
 
+        # the document's hash key is kept here rather than on the cacher, so
+        # one cacher can be shared by documents loading at the same time
         if parse_tree_cacher:
             self._parse_tree_cacher = parse_tree_cacher
-            self._parse_tree_cacher.set_hash_key(self.file)
+            self._hash_key = parse_tree_cacher.file_key(self.file)
         else:
             self._parse_tree_cacher = DummyCache()
+            self._hash_key = None
 
         # set up layout parsing
         rsrcmgr = PDFResourceManager()
@@ -363,10 +819,84 @@ class PDFQuery(object):
         self.device = PDFPageAggregator(rsrcmgr, laparams=laparams)
         self.interpreter = PDFPageInterpreter(rsrcmgr, self.device)
 
+        # identifies the options that change the parse tree, so cached pages
+        # are only reused by PDFQuery objects with the same options and
+        # cache format
+        if input_text_formatter:
+            formatter_fingerprint = _callable_fingerprint(input_text_formatter)
+        else:
+            formatter_fingerprint = normalize_spaces
+        self._options_fingerprint = _fingerprint(
+            CACHE_FORMAT_VERSION, merge_tags, round_floats, round_digits, resort, formatter_fingerprint,
+            sorted(vars(laparams).items()) if laparams else None, char_level,
+            sorted(attributes) if attributes is not None else None, sort_tolerance,
+        )
+
         # caches
         self._pages = []
         self._pages_iter = None
-        self._elements = []
+        self._page_texts = {}  # page number -> (text lines, words)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """
+            Release pdf.tree, pdf.pq and the pdfminer objects held for the
+            document, and close the file if PDFQuery opened it. Elements
+            still referenced elsewhere keep working, but can no longer load
+            their .layout on demand. Also called when a PDFQuery is used as
+            a context manager::
+
+                >>> with PDFQuery("tests/samples/IRS_1040A.pdf") as pdf:
+                ...     pdf.load(0)
+        """
+        if self.tree is not None:
+            self.tree.getroot()._load_layouts = None
+            self.tree.getroot()._load_placeholders = None
+        self.tree = None
+        self.pq = None
+        self._pages = []
+        self._pages_iter = None
+        self._page_texts = {}
+        self._release_device_layout()
+        file = self.file
+        if isinstance(file, BufferFile):
+            file.close()
+            file = file.file
+        if self._owns_file:
+            file.close()
+
+    def release_pages(self, *page_numbers):
+        """
+            Remove the given pages (all pages if none are given) from
+            pdf.tree, so that their elements and layout objects are freed
+            once nothing else refers to them. Page numbers can be given as
+            for load(). Released pages can be loaded again later.
+
+            >>> pdf.load(0, 1)
+            >>> pdf.release_pages(0)
+            >>> pdf.pq('LTPage')
+            [<LTPage>]
+        """
+        if self.tree is None:
+            return
+        root = self.tree.getroot()
+        page_indexes = set(obj_to_string(n) for n in _flatten(page_numbers))
+        released = [page for page in root.iterchildren('LTPage')
+                    if not page_indexes or page.get('page_index') in page_indexes]
+        indexes = getattr(root, '_bbox_indexes', {})
+        placeholders = getattr(root, '_placeholders', {})
+        for page in released:
+            root.remove(page)
+            indexes.pop(page, None)
+            placeholders.pop(page, None)
+        root._elements = [page for page in getattr(root, '_elements', [])
+                          if page.getparent() is not None]
+        self._release_device_layout()
 
     def load(self, *page_numbers):
         """
@@ -385,57 +915,258 @@ class PDFQuery(object):
         >>> pdf.load(0, 1)
         >>> pdf.pq('LTPage')
         [<LTPage>, <LTPage>]
+
+        If PDFQuery was created with lazy=True, pages are only built when a
+        query needs them; see _get_lazy_tree().
         """
-        self.tree = self.get_tree(*_flatten(page_numbers))
+        if self.lazy:
+            self.tree = self._get_lazy_tree(*_flatten(page_numbers))
+        else:
+            self.tree = self.get_tree(*_flatten(page_numbers))
         self.pq = self.get_pyquery(self.tree)
 
     def extract(self, searches, tree=None, as_dict=True):
         """
+            Apply a list of searches, or an ExtractionPlan, to tree or to
+            the whole document. See Bulk Data Scraping in the README.
+
             >>> foo = pdf.extract([['pages', 'LTPage']])
             >>> foo
             {'pages': [<LTPage>, <LTPage>]}
             >>> pdf.extract([['bar', ':in_bbox("100,100,400,400")']], foo['pages'][0])
             {'bar': [<LTTextLineHorizontal>, <LTTextBoxHorizontal>,...
         """
-        if self.tree is None or self.pq is None:
-            self.load()
         if tree is None:
+            if self.tree is None or self.pq is None:
+                self.load()
             pq = self.pq
         else:
-            pq = PyQuery(tree, css_translator=PDFQueryTranslator())
-        results = []
-        formatter = None
-        parent = pq
-        for search in searches:
-            if len(search) < 3:
-                search = list(search) + [formatter]
-            key, search, tmp_formatter = search
-            if key == 'with_formatter':
-                if isinstance(search, six.string_types):
-                    # is a pyquery method name, e.g. 'text'
-                    formatter = lambda o, search=search: getattr(o, search)()
-                elif hasattr(search, '__call__') or not search:
-                    # is a method, or None to end formatting
-                    formatter = search
-                else:
-                    raise TypeError("Formatter should be either a pyquery "
-                                    "method name or a callable function.")
-            elif key == 'with_parent':
-                parent = pq(search) if search else pq
+            pq = PDFPyQuery(tree, css_translator=_translator)
+        if not isinstance(searches, ExtractionPlan):
+            searches = ExtractionPlan(searches)
+        if self.stats is None:
+            return searches.extract(pq, as_dict)
+        start = timer()
+        result = searches.extract(pq, as_dict)
+        self.stats.record_time('extract', None, timer() - start)
+        return result
+
+    def iter_pages(self, searches, page_numbers=None):
+        """
+            Build one page at a time, apply searches to it, and yield
+            (page_index, result) before moving on to the next page. Only the
+            current page is kept in memory, so this suits documents too long
+            to load() at once. pdf.tree and pdf.pq are left alone.
+
+            searches can be a selector, a filtering function, or a list of
+            searches or ExtractionPlan for extract(), in which case result is
+            what extract() returns for that page.
+
+            >>> for n, lines in pdf.iter_pages('LTTextLineHorizontal:contains("perjury")'):
+            ...     print(n, lines.text())
+            0
+            1 Under penalties of perjury, ...
+        """
+        if page_numbers is None:
+            page_numbers = range(len(self._cached_pages()))
+        if isinstance(searches, (list, tuple)):
+            searches = ExtractionPlan(searches)
+        for n in _flatten(list(page_numbers)):
+            root = self.get_tree(n).getroot()
+            if isinstance(searches, ExtractionPlan):
+                result = self.extract(searches, root)
             else:
-                try:
-                    result = parent("*").filter(search) if \
-                        hasattr(search, '__call__') else parent(search)
-                except cssselect.SelectorSyntaxError as e:
-                    raise cssselect.SelectorSyntaxError(
-                        "Error applying selector '%s': %s" % (search, e))
-                if tmp_formatter:
-                    result = tmp_formatter(result)
-                results += result if type(result) == tuple else [[key, result]]
-        if as_dict:
-            results = dict(results)
+                pq = self.get_pyquery(root)
+                result = pq("*").filter(searches) if \
+                    hasattr(searches, '__call__') else pq(searches)
+            del root
+            yield n, result
+
+    def query_bbox(self, page, x0, y0, x1, y1, tags=None, overlap=False):
+        """
+            Return a pyquery object with the elements on page that are within
+            the given bbox, or overlap it if overlap is set -- the same
+            elements, in the same order, as the :in_bbox() and
+            :overlaps_bbox() selectors. tags can be a tag name or list of tag
+            names to return. page is an LTPage element, or the page_index of
+            a page in pdf.tree.
+
+            Each page's elements are indexed by bbox the first time the page
+            is queried, so later queries only check nearby elements. Selectors
+            made of a single :in_bbox() or :overlaps_bbox() use the same
+            index. After adding elements or changing their positions, call
+            invalidate_bbox_indexes().
+
+            >>> pdf.query_bbox(0, 315, 680, 395, 700, tags='LTTextLineHorizontal').text()
+            'Michaels'
+        """
+        if not isinstance(page, etree._Element):
+            if self.tree is None:
+                self.load()
+            page_index = page
+            page = self.tree.getroot().find('LTPage[@page_index="%s"]' % page_index)
+            if page is None:
+                raise IndexError("Page %s is not loaded." % page_index)
+        self._load_placeholders([page])
+        return self.get_pyquery(bbox_index(page).query(x0, y0, x1, y1, tags, overlap))
+
+    def invalidate_bbox_indexes(self):
+        """ Rebuild the bbox indexes of every page on next use, for after
+        the tree has been edited. """
+        if self.tree is not None:
+            invalidate_bbox_indexes(self.tree.getroot())
+
+    def text_in_bboxes(self, page, bboxes):
+        """
+            For each (x0, y0, x1, y1) in bboxes, return the text of the text
+            lines on page (a page number) that are within it, joined with
+            spaces. Lines of both directions are included, so this is the
+            text the :in_bbox() selector finds for horizontal and vertical
+            text lines, e.g. for page 0::
+
+                pdf.pq('LTPage[page_index="0"] LTTextLineHorizontal:in_bbox("315,680,395,700"), '
+                       'LTPage[page_index="0"] LTTextLineVertical:in_bbox("315,680,395,700")').text()
+
+            but it is read straight from the pdfminer layout, without
+            building elements, so it is much cheaper when text is all you
+            need. Text is formatted with input_text_formatter, and lines
+            come in the same order as in the tree. The one difference: when
+            a text box is the same size as one of its lines, resort nests
+            the box inside the line, so the selector repeats that text.
+            Here it appears once.
+
+            >>> pdf.text_in_bboxes(0, [(315, 680, 395, 700), (170, 680, 210, 700)])
+            ['Michaels', 'John E.']
+        """
+        lines = self._page_text(page)[0]
+        results = []
+        for x0, y0, x1, y1 in bboxes:
+            results.append(' '.join(
+                text for line_x0, line_y0, line_x1, line_y1, text in lines
+                if line_x0 >= x0 and line_y0 >= y0 and line_x1 <= x1 and line_y1 <= y1))
         return results
 
+    def words(self, page):
+        """
+            Return (x0, y0, x1, y1, text) for each word on page (a page
+            number): runs of characters between spaces in each text line, in
+            line order. Like text_in_bboxes(), this reads the pdfminer layout
+            without building elements. Both keep what they read from each
+            page until close().
+        """
+        return list(self._page_text(page)[1])
+
+    def _page_text(self, n):
+        """ Return (lines, words) for page n, as lists of (x0, y0, x1, y1,
+        text) tuples, reading the page's layout the first time. """
+        page_text = self._page_texts.get(n)
+        if page_text is None:
+            # leave pageids alone for pages built later
+            pageno = self.device.pageno
+            layout = self.get_layout(n)
+            self.device.pageno = pageno
+            page_text = self._page_texts[n] = self._read_text(layout)
+            self._release_device_layout()
+        return page_text
+
+    def _read_text(self, layout):
+        """
+            Collect the text lines and words of layout, with lines in the
+            order the tree would have them: pdfminer's order, or with resort
+            on, nested by bbox and sorted the way _build_page() does it.
+        """
+        if self.resort:
+            text_lines = self._resorted_text_lines(layout)
+        else:
+            text_lines = []
+            stack = [layout]
+            while stack:
+                node = stack.pop()
+                if isinstance(node, LTTextLine):
+                    text_lines.append(node)
+                elif hasattr(node, '__iter__'):
+                    stack.extend(reversed(list(node)))
+
+        formatter = self.input_text_formatter
+        lines = []
+        words = []
+        for line in text_lines:
+            text = strip_invalid_xml_chars(line.get_text())
+            if formatter:
+                text = formatter(text)
+            lines.append(tuple(self._node_bbox(line)) + (text.strip(),))
+            words += self._line_words(line)
+        return lines, words
+
+    def _resorted_text_lines(self, layout):
+        """ Return the text lines of layout in the order resort puts them
+        in, working on bboxes alone instead of elements. """
+        # nodes in the order _xmlize() collects them, descendants first
+        nodes = []
+        stack = [(layout, False)]
+        while stack:
+            node, visited = stack.pop()
+            if visited:
+                nodes.append(node)
+                continue
+            if node is not layout:
+                stack.append((node, True))
+            # annotations are already elements, and take part in nesting
+            if hasattr(node, '__iter__') and not isinstance(node, (LTTextLine, LayoutElement)):
+                stack.extend((child, False) for child in reversed(list(node))
+                             if not isinstance(child, (LTChar, LTAnno)))
+        bboxes = [element_bbox(node) if isinstance(node, LayoutElement) else self._node_bbox(node)
+                  for node in nodes]
+        parents, order = nest_indexes(bboxes)
+
+        children = {}
+        for i in order:
+            children.setdefault(parents[i], []).append(i)
+        text_lines = []
+        stack = [-1]
+        while stack:
+            i = stack.pop()
+            if i >= 0 and isinstance(nodes[i], LTTextLine):
+                text_lines.append(nodes[i])
+            if i in children:
+                ordered = self._reading_order([(bboxes[j], j) for j in children[i]])
+                stack.extend(j for bbox, j in reversed(ordered))
+        return text_lines
+
+    def _reading_order(self, items):
+        """ Sort (bbox, item) pairs top to bottom and left to right, as
+        _sort() does. """
+        keyed = [((0, -bbox[3], bbox[0]) if bbox else _unplaced_sort_key, (bbox, item))
+                 for bbox, item in items]
+        keyed.sort(key=itemgetter(0))
+        if self.sort_tolerance:
+            keyed = _sort_lines(keyed, self.sort_tolerance)
+        return [pair for key, pair in keyed]
+
+    def _line_words(self, line):
+        """ Return (x0, y0, x1, y1, text) for the words in a text line. """
+        words = []
+        chars = []
+        for child in list(line) + [None]:
+            text = None if child is None else strip_invalid_xml_chars(child.get_text())
+            bbox = None if isinstance(child, LTAnno) or child is None else self._node_bbox(child)
+            if text and not text.isspace() and bbox is not None:
+                chars.append((bbox, text))
+                continue
+            if chars:
+                text = ''.join(char_text for char_bbox, char_text in chars)
+                if self.input_text_formatter:
+                    text = self.input_text_formatter(text)
+                if text:
+                    words.append((
+                        min(char_bbox[0] for char_bbox, char_text in chars),
+                        min(char_bbox[1] for char_bbox, char_text in chars),
+                        max(char_bbox[2] for char_bbox, char_text in chars),
+                        max(char_bbox[3] for char_bbox, char_text in chars),
+                        text))
+                chars = []
+        return words
+
     # tree building stuff
     def get_pyquery(self, tree=None, page_numbers=None):
         """
@@ -452,101 +1183,374 @@ class PDFQuery(object):
                 tree = self.get_tree(page_numbers)
         if hasattr(tree, 'getroot'):
             tree = tree.getroot()
-        return PyQuery(tree, css_translator=PDFQueryTranslator())
+        return PDFPyQuery(tree, css_translator=_translator)
 
     def get_tree(self, *page_numbers):
         """
             Return lxml.etree.ElementTree for entire document, or page numbers
             given if any.
         """
-        cache_key = "_".join(map(str, _flatten(page_numbers)))
-        tree = self._parse_tree_cacher.get(cache_key)
-        if tree is None:
-            # set up root
-            root = parser.makeelement("pdfxml")
-            if self.doc.info:
-                for k, v in list(self.doc.info[0].items()):
-                    k = obj_to_string(k)
-                    v = obj_to_string(resolve1(v))
-                    try:
+        # set up root
+        root = parser.makeelement("pdfxml")
+        if self.doc.info:
+            for k, v in list(self.doc.info[0].items()):
+                k = obj_to_string(k)
+                v = obj_to_string(resolve1(v))
+                try:
+                    root.set(k, v)
+                except ValueError as e:
+                    # Sometimes keys have a character in them, like ':',
+                    # that isn't allowed in XML attribute names.
+                    # If that happens we just replace non-word characters
+                    # with '_'.
+                    if "Invalid attribute name" in e.args[0]:
+                        k = re.sub(r'\W', '_', k)
                         root.set(k, v)
-                    except ValueError as e:
-                        # Sometimes keys have a character in them, like ':',
-                        # that isn't allowed in XML attribute names.
-                        # If that happens we just replace non-word characters
-                        # with '_'.
-                        if "Invalid attribute name" in e.args[0]:
-                            k = re.sub(r'\W', '_', k)
-                            root.set(k, v)
-
-            # Parse pages and append to root.
-            # If nothing was passed in for page_numbers, we do this for all
-            # pages, but if None was explicitly passed in, we skip it.
-            if not(len(page_numbers) == 1 and page_numbers[0] is None):
-                if page_numbers:
-                    pages = [[n, self.get_layout(self.get_page(n))] for n in
-                             _flatten(page_numbers)]
-                else:
-                    pages = enumerate(self.get_layouts())
-                for n, page in pages:
-                    page = self._xmlize(page)
-                    if self.resort:
-                        self._sort(page)
-                    page.set('page_index', obj_to_string(n))
-                    page.set('page_label', self.doc.get_page_number(n))
-                    root.append(page)
-                self._clean_text(root)
-
-            # wrap root in ElementTree
-            tree = etree.ElementTree(root)
-            self._parse_tree_cacher.set(cache_key, tree)
 
+        # let elements load their .layout on demand; see LayoutElement
+        if self.keep_layout:
+            root._load_layouts = self._load_layouts
+        # let selectors applied to the tree record their time
+        root._stats = self.stats
+
+        # Parse pages and append to root.
+        # If nothing was passed in for page_numbers, we do this for all
+        # pages, but if None was explicitly passed in, we skip it.
+        root._elements = []
+        if not(len(page_numbers) == 1 and page_numbers[0] is None):
+            page_numbers = list(_flatten(page_numbers)) or \
+                list(range(len(self._cached_pages())))
+            self._append_pages(root, self._get_pages(page_numbers))
+
+        # wrap root in ElementTree
+        return etree.ElementTree(root)
+
+    def _get_lazy_tree(self, *page_numbers):
+        """
+            Like get_tree(), but with a placeholder LTPage for each page,
+            with the attributes the page will have but no contents. Selectors
+            applied with pdf.pq or extract() build the placeholder pages they
+            could match or descend into first (see
+            CompiledSelector._load_lazy_pages()), so
+            'LTPage[page_index="0"] LTTextLineHorizontal' only builds page 0.
+            Pages get the same pageid as if they were all built now.
+        """
+        tree = self.get_tree(None)
+        if len(page_numbers) == 1 and page_numbers[0] is None:
+            return tree
+        root = tree.getroot()
+        root._placeholders = {}  # placeholder page -> page number
+        root._load_placeholders = self._load_placeholders
+        pages = []
+        for n in (list(page_numbers) or list(range(len(self._cached_pages())))):
+            page = self._placeholder_page(n, self.device.pageno + len(pages))
+            root._placeholders[page] = n
+            pages.append(page)
+        self.device.pageno += len(pages)
+        self._append_pages(root, pages)
         return tree
 
+    def _placeholder_page(self, n, pageid):
+        """ Return an empty LTPage element with the attributes page n will
+        have once built with the given pageid. """
+        pdf_page = self.get_page(n)
+        (x0, y0, x1, y1) = pdf_page.mediabox
+        if pdf_page.rotate == 90:
+            ctm = (0, -1, 1, 0, -y0, x1)
+        elif pdf_page.rotate == 180:
+            ctm = (-1, 0, 0, -1, x1, y1)
+        elif pdf_page.rotate == 270:
+            ctm = (0, 1, -1, 0, y1, -x0)
+        else:
+            ctm = (1, 0, 0, 1, -x0, -y0)
+
+        # let pdfminer make the LTPage as the interpreter would
+        pageno = self.device.pageno
+        self.device.pageno = pageid
+        self.device.begin_page(pdf_page, ctm)
+        layout = self.device.cur_item
+        self.device.pageno = pageno
+        self._release_device_layout()
+
+        page = parser.makeelement('LTPage', self._getattrs(layout, *self._get_attribute_names(LTPage)))
+        page.set('page_index', obj_to_string(n))
+        page.set('page_label', self.doc.get_page_number(n))
+        return page
+
+    def _load_placeholders(self, pages):
+        """
+            Build any placeholder pages among pages (see _get_lazy_tree())
+            and fill the placeholder elements in, so that elements already
+            referring to them stay valid.
+        """
+        if not pages:
+            return
+        root = pages[0].getroottree().getroot()
+        placeholders = getattr(root, '_placeholders', None)
+        pages = [page for page in pages if placeholders and page in placeholders]
+        if not pages:
+            return
+
+        # keep the pageids the placeholders were given
+        pageno = self.device.pageno
+        built_pages = self._get_pages([placeholders[page] for page in pages])
+        self.device.pageno = pageno
+
+        indexes = getattr(root, '_bbox_indexes', {})
+        for page, built in zip(pages, built_pages):
+            del placeholders[page]
+            indexes.pop(page, None)
+            pageid = page.get('pageid')
+            page.attrib.clear()
+            page.attrib.update(built.attrib)
+            if pageid is not None:
+                page.set('pageid', pageid)
+            page.text = built.text
+            page[:] = list(built)
+            page._elements = getattr(built, '_elements', [])
+            geometry = getattr(built, '_geometry', None)
+            if geometry is not None:
+                if built in geometry.rows:
+                    geometry.rows[page] = geometry.rows.pop(built)
+                page._geometry = geometry
+            layout = getattr(built, '_layout', None)
+            if layout is not None:
+                page.layout = layout
+
+    def _append_pages(self, root, pages):
+        """ Append LTPage elements to a root made by get_tree(). The root
+        keeps the pages' Python objects, and with them the elements and
+        layouts the pages keep, for as long as the tree lives. """
+        for page in pages:
+            root.append(page)
+            root._elements.append(page)
+
+    def _get_pages(self, page_numbers):
+        """
+            Return cleaned LTPage elements for the given page numbers, taking
+            each page from the parse tree cache if possible, and building and
+            caching the rest.
+        """
+        stats = self.stats
+        cache = self._parse_tree_cacher
+        pageno = self.device.pageno
+        pages = []
+        for n in page_numbers:
+            start = timer()
+            page = cache.get(self._page_cache_key(n), hash_key=self._hash_key)
+            if stats is not None:
+                stats.record_time('cache_get', n, timer() - start)
+                stats.record_cache_lookup(n, page is not None)
+            pages.append(page if page is None else page.getroot())
+
+        missing = [n for n, page in zip(page_numbers, pages) if page is None]
+        if missing:
+            if self.workers and self.workers > 1:
+                built = self._build_pages_in_workers(missing)
+            else:
+                built = (self._build_page(n, self.get_layout(n)) for n in missing)
+            for i, page in enumerate(pages):
+                if page is None:
+                    n = page_numbers[i]
+                    page = pages[i] = next(built)
+                    start = timer()
+                    self._clean_text(page)
+                    cleaned = timer()
+                    written = cache.stats.bytes_written
+                    cache.set(self._page_cache_key(n), etree.ElementTree(page), hash_key=self._hash_key)
+                    if stats is not None:
+                        stats.record_time('clean_text', n, cleaned - start)
+                        stats.record_time('cache_set', n, timer() - cleaned)
+                        stats.record_bytes_serialized(n, cache.stats.bytes_written - written)
+            self._release_device_layout()
+        if stats is not None:
+            for n, page in zip(page_numbers, pages):
+                stats.record_elements(n, page)
+
+        # pdfminer numbers LTPage pageids by counting the pages processed by
+        # the device, so renumber pages as if all of them had been parsed now.
+        for i, page in enumerate(pages):
+            if page.get('pageid') is not None:
+                page.set('pageid', obj_to_string(pageno + i))
+        self.device.pageno = pageno + len(pages)
+        return pages
+
+    def _load_layouts(self, element):
+        """
+            Set .layout for every element on element's page by running
+            pdfminer on that page again. Used for pages that were restored
+            from the parse tree cache or built by workers.
+        """
+        if element.tag == 'LTPage':
+            page = element
+        else:
+            page = next(element.iterancestors('LTPage'), None)
+        if page is None or page.get('page_index') is None:
+            return
+        if page in getattr(page.getparent(), '_placeholders', ()):
+            self._load_placeholders([page])
+            return
+
+        # rebuild the page with the pageid it has in the tree, without
+        # disturbing later pageids or pinned elements
+        pageno = self.device.pageno
+        if page.get('pageid') is not None:
+            self.device.pageno = int(page.get('pageid'))
+        built = self._build_page(int(page.get('page_index')),
+                                 self.get_layout(int(page.get('page_index'))))
+        self.device.pageno = pageno
+        self._release_device_layout()
+
+        # the rebuilt page has the same structure as the cached one, so match
+        # elements up in document order
+        elements = list(page.iter())
+        for el in elements:
+            el.layout = None
+        for el, built_el in zip(elements, built.iter()):
+            if el.tag != built_el.tag:
+                break
+            # annotations are their own layout objects
+            el.layout = el if built_el.layout is built_el else built_el.layout
+        page._elements = elements[1:]  # make sure layout keeps state
+
+    def _release_device_layout(self):
+        """ Drop the pdfminer device's references to the last page it laid
+        out, so that the layout lives only as long as elements using it. """
+        self.device.result = None
+        self.device.cur_item = None
+
+    def _page_cache_key(self, n):
+        """ Parse tree cache key for page n, as built with our options. """
+        return "_page%s_%s" % (n, self._options_fingerprint)
+
+    def _build_page(self, n, layout):
+        """ Convert layout for page n to an LTPage element. """
+        start = timer()
+        resorted = [] if self.resort else None
+        page = self._xmlize(layout, resorted=resorted)
+        xmlized = timer()
+        if resorted:
+            geometry = page._geometry
+            nest_by_bbox(page, resorted, [
+                geometry.get(el) or element_bbox(el) for el in resorted])
+        nested = timer()
+        if self.resort:
+            self._sort(page)
+        if self.stats is not None:
+            self.stats.record_time('xmlize', n, xmlized - start)
+            if self.resort:
+                self.stats.record_time('resort', n, nested - xmlized)
+                self.stats.record_time('sort', n, timer() - nested)
+        page.set('page_index', obj_to_string(n))
+        page.set('page_label', self.doc.get_page_number(n))
+        return page
+
+    def _build_pages_in_workers(self, page_numbers):
+        """
+            Build LTPage elements for the given page numbers (or all pages)
+            in a pool of self.workers processes. Each worker reopens the
+            document and builds a contiguous range of pages, which are
+            returned in page order. Elements built this way load their
+            .layout on demand, like pages restored from the cache.
+        """
+        chunk_size = -(-len(page_numbers) // self.workers)
+        source = self._worker_source()
+
+        # pdfminer numbers LTPage pageids by counting pages processed by the
+        # device, so give each worker the pageid its first page would have
+        # gotten here, and move our own count past the pages they build.
+        pageno = self.device.pageno
+        self.device.pageno += len(page_numbers)
+
+        tasks = [(source, self._worker_options, page_numbers[i:i + chunk_size], pageno + i)
+                 for i in range(0, len(page_numbers), chunk_size)]
+        pool = multiprocessing.Pool(min(self.workers, len(tasks)))
+        try:
+            for pages in pool.imap(_build_pages_in_worker, tasks):
+                for page in pages:
+                    yield etree.fromstring(page, parser)
+        finally:
+            pool.terminate()
+
+    def _worker_source(self):
+        """ Return ('path', path) for workers to reopen the file, or
+        ('data', contents) if the file doesn't have a usable path. On Python
+        2 both are str, so the kind is passed along explicitly. """
+        path = getattr(self.file, 'name', None)
+        if isinstance(path, six.string_types) and os.path.isfile(path):
+            return 'path', path
+        position = self.file.tell()
+        self.file.seek(0)
+        data = self.file.read()
+        self.file.seek(position)
+        return 'data', data
+
     def _clean_text(self, branch):
         """
             Remove text from node if same text exists in its children.
             Apply string formatter if set.
         """
-        if branch.text and self.input_text_formatter:
-            branch.text = self.input_text_formatter(branch.text)
+        text = branch.text
+        if text and self.input_text_formatter:
+            text = branch.text = self.input_text_formatter(text)
+
+        # Each child's text is removed from the first place it occurs in the
+        # rest of branch's text. Children usually appear in order at the
+        # start of what's left, so keep a cursor past the removed text
+        # instead of searching and copying the whole string for each child.
+        pos = 0
         try:
             for child in branch:
                 self._clean_text(child)
-                if branch.text and branch.text.find(child.text) >= 0:
-                    branch.text = branch.text.replace(child.text, '', 1)
+                if text and pos < len(text):
+                    child_text = child.text
+                    if text.startswith(child_text, pos):
+                        pos += len(child_text)
+                    elif text.find(child_text, pos) >= 0:
+                        text = text[pos:].replace(child_text, '', 1)
+                        pos = 0
+                        branch.text = text
         except TypeError:  # not an iterable node
             pass
+        finally:
+            if pos:
+                branch.text = text[pos:]
 
-    def _xmlize(self, node, root=None):
+    def _xmlize(self, node, root=None, resorted=None):
+        """
+            Convert layout node to an element. If resorted is a list,
+            descendants are collected in it instead of being appended to their
+            parents, for _build_page() to nest them by bbox.
+        """
         if isinstance(node, LayoutElement):
             # Already an XML element we can use
             branch = node
         else:
             # collect attributes of current node
-            tags = self._getattrs(
-                node, 'y0', 'y1', 'x0', 'x1', 'width', 'height', 'bbox',
-                'linewidth', 'pts', 'index', 'name', 'matrix', 'word_margin'
-            )
-            if type(node) == LTImage:
-                tags.update(self._getattrs(
-                    node, 'colorspace', 'bits', 'imagemask', 'srcsize',
-                    'stream', 'name', 'pts', 'linewidth')
-                )
-            elif type(node) == LTChar:
-                tags.update(self._getattrs(
-                    node, 'fontname', 'adv', 'upright', 'size')
-                )
-            elif type(node) == LTPage:
-                tags.update(self._getattrs(node, 'pageid', 'rotate'))
+            node_type = type(node)
+            attribute_names = self._attribute_names.get(node_type)
+            if attribute_names is None:
+                attribute_names = self._attribute_names[node_type] = \
+                    self._get_attribute_names(node_type)
+            tags = self._getattrs(node, *attribute_names)
 
             # create node
             branch = parser.makeelement(node.__class__.__name__, tags)
 
-        branch.layout = node
-        self._elements += [branch]  # make sure layout keeps state
+        if self.keep_layout:
+            branch.layout = node
         if root is None:
+            # The root keeps the Python objects of the elements below it,
+            # which lxml would otherwise discard along with their .layout.
             root = branch
+            root._elements = []
+            root._geometry = GeometryTable()
+        elif self.keep_layout:
+            root._elements.append(branch)  # make sure layout keeps state
+        if branch is not node:
+            bbox = self._node_bbox(node)
+            if bbox is not None:
+                root._geometry.add(branch, bbox)
 
         # add text
         if hasattr(node, 'get_text'):
@@ -556,8 +1560,22 @@ class PDFQuery(object):
         if hasattr(node, '__iter__'):
             last = None
             for child in node:
-                child = self._xmlize(child, root)
-                if self.merge_tags and child.tag in self.merge_tags:
+                if isinstance(child, (LTChar, LTAnno)) and self.char_level != 'full':
+                    # Decide what happens to characters before building
+                    # elements for them, since most are dropped or merged.
+                    if self.char_level == 'drop':
+                        continue
+                    if self.merge_tags and child.__class__.__name__ in self.merge_tags:
+                        text = strip_invalid_xml_chars(child.get_text())
+                        if branch.text and text in branch.text:
+                            continue
+                        elif last is not None and last.tag in self.merge_tags:
+                            last.text += text
+                            last.set('_obj_id', last.get('_obj_id', '') + ",")
+                            continue
+                child = self._xmlize(child, root, resorted)
+                if self.merge_tags and child.tag in self.merge_tags and \
+                        not (self.char_level == 'full' and child.tag in ('LTChar', 'LTAnno')):
                     if branch.text and child.text in branch.text:
                         continue
                     elif last is not None and last.tag in self.merge_tags:
@@ -568,20 +1586,73 @@ class PDFQuery(object):
                         )
                         continue
                 # sort children by bounding boxes
-                if self.resort:
-                    _append_sorted(root, child, _comp_bbox)
+                if resorted is not None:
+                    resorted.append(child)
                 else:
                     branch.append(child)
                 last = child
         return branch
 
     def _sort(self, tree):
-        """ Sort same-level elements top to bottom and left to right. """
-        children = list(tree)
-        if children:
-            tree[:] = sorted(children, key=lambda child: (-float(child.get('y1')), float(child.get('x0'))))
-            for child in children:
-                self._sort(child)
+        """
+            Sort same-level elements top to bottom and left to right, at
+            every level of tree. Elements without a position, like LTAnno, go
+            last. If self.sort_tolerance is set, elements whose tops are
+            within that distance below the top of the first element of a line
+            are on that line, and are sorted left to right.
+        """
+        geometry = page_geometry(tree)
+        rows = geometry.rows if geometry else {}
+        coords = geometry.coords if geometry else None
+        parents = [el for el in tree.iter() if len(el)]
+        for parent in parents:
+            keyed = []
+            for child in parent:
+                row = rows.get(child)
+                if row is not None:
+                    key = (0, -coords[row * 4 + 3], coords[row * 4])
+                elif child.get('y1') is not None and child.get('x0') is not None:
+                    key = (0, -float(child.get('y1')), float(child.get('x0')))
+                else:
+                    key = _unplaced_sort_key
+                keyed.append((key, child))
+            keyed.sort(key=itemgetter(0))
+            if self.sort_tolerance:
+                keyed = _sort_lines(keyed, self.sort_tolerance)
+            parent[:] = [child for key, child in keyed]
+
+    def _node_bbox(self, node):
+        """ Return the floats node's x0/y0/x1/y1 attributes will parse to,
+        or None if it doesn't have them or they aren't plain numbers. """
+        try:
+            values = (node.x0, node.y0, node.x1, node.y1)
+        except AttributeError:
+            return None
+        bbox = []
+        for value in values:
+            value_type = type(value)
+            if value_type == float:
+                if self.round_floats:
+                    value = round(value, self.round_digits)
+            elif value_type != int:
+                return None
+            bbox.append(float(value))
+        return bbox
+
+    def _get_attribute_names(self, node_type):
+        """ Return names of the attributes to copy from layout objects of the
+        given type, in the order they appear in the tree. """
+        names = ['y0', 'y1', 'x0', 'x1', 'width', 'height', 'bbox',
+                 'linewidth', 'pts', 'index', 'name', 'matrix', 'word_margin']
+        if node_type == LTImage:
+            names += ['colorspace', 'bits', 'imagemask', 'srcsize', 'stream']
+        elif node_type == LTChar:
+            names += ['fontname', 'adv', 'upright', 'size']
+        elif node_type == LTPage:
+            names += ['pageid', 'rotate']
+        if self.attributes is not None:
+            names = [name for name in names if name in self.attributes]
+        return names
 
     def _getattrs(self, obj, *attrs):
         """ Return dictionary of given attrs on given object, if they exist,
@@ -590,11 +1661,25 @@ class PDFQuery(object):
         filtered_attrs = {}
         for attr in attrs:
             if hasattr(obj, attr):
-                filtered_attrs[attr] = obj_to_string(
-                    self._filter_value(getattr(obj, attr))
-                )
+                filtered_attrs[attr] = self._value_to_string(getattr(obj, attr))
         return filtered_attrs
 
+    def _value_to_string(self, val):
+        """ Same as obj_to_string(self._filter_value(val)), with fast paths
+        for numbers and lists of numbers, which most attributes are. """
+        val_type = type(val)
+        if val_type == float:
+            if self.round_floats:
+                val = round(val, self.round_digits)
+            if val - val == 0:  # not inf or nan, which json spells differently
+                return repr(val)
+        elif val_type == int:
+            return str(val)
+        elif val_type == tuple or val_type == list:
+            if all(type(item) in _number_list_types for item in val):
+                return u'[%s]' % u', '.join(self._value_to_string(item) for item in val)
+        return obj_to_string(self._filter_value(val))
+
     def _filter_value(self, val):
         if self.round_floats:
             if type(val) == float:
@@ -610,11 +1695,16 @@ class PDFQuery(object):
 
     def get_layout(self, page):
         """ Get PDFMiner Layout object for given page object or page number. """
+        page_index = None
         if type(page) == int:
+            page_index = page
             page = self.get_page(page)
+        start = timer()
         self.interpreter.process_page(page)
         layout = self.device.get_result()
         layout = self._add_annots(layout, page.annots)
+        if self.stats is not None:
+            self.stats.record_time('layout', page_index, timer() - start)
         return layout
 
     def get_layouts(self):
@@ -655,7 +1745,9 @@ class PDFQuery(object):
         """
         if annots:
             for annot in resolve1(annots):
-                annot = resolve1(annot)
+                # copy, so the document's own objects aren't modified and
+                # the page can be laid out again
+                annot = dict(resolve1(annot))
                 if annot.get('Rect') is not None:
                     annot['bbox'] = annot.pop('Rect')  # Rename key
                     annot = self._set_hwxy_attrs(annot)
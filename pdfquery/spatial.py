@@ -0,0 +1,289 @@
+"""
+Numeric spatial helpers used to arrange and search layout elements by
+bounding box without re-parsing their string attributes.
+"""
+from __future__ import division
+
+import itertools
+import math
+import re
+from array import array
+
+import six
+
+
+_bbox_keys = ('x0', 'y0', 'x1', 'y1')
+
+
+def element_bbox(el):
+    """ Return (x0, y0, x1, y1) floats for an element with x0/y0/x1/y1
+    attributes, or None if any of them is missing. """
+    values = [el.get(key) for key in _bbox_keys]
+    if None in values:
+        return None
+    return tuple(float(v) for v in values)
+
+
+class GeometryTable(object):
+    """
+        Numeric bboxes of the elements of a page, recorded while the page is
+        built, stored as four doubles per element. The values are the floats
+        the x0/y0/x1/y1 attributes parse to, so code that works with
+        positions can use them instead of parsing the attributes again.
+    """
+
+    def __init__(self):
+        self.coords = array('d')
+        self.rows = {}
+
+    def add(self, el, bbox):
+        self.rows[el] = len(self.coords) // 4
+        self.coords.extend(bbox)
+
+    def get(self, el):
+        """ Return (x0, y0, x1, y1) recorded for el, or None. """
+        row = self.rows.get(el)
+        if row is None:
+            return None
+        return tuple(self.coords[row * 4:row * 4 + 4])
+
+
+def page_geometry(el):
+    """ Return the GeometryTable of el's page, or None if it doesn't have one. """
+    page = el if el.tag == 'LTPage' else next(el.iterancestors('LTPage'), None)
+    return getattr(page, '_geometry', None)
+
+
+class BBoxGrid(object):
+    """
+        Uniform grid over a rectangle. Each item is registered in every cell
+        its bbox overlaps, so items near a bbox can be found without scanning
+        every item. Items outside the grid bounds are clamped to the edge
+        cells.
+    """
+
+    def __init__(self, x0, y0, x1, y1, cells_per_side):
+        self.x0 = x0
+        self.y0 = y0
+        self.size = max(1, int(cells_per_side))
+        self.cell_width = (x1 - x0) / self.size or 1.0
+        self.cell_height = (y1 - y0) / self.size or 1.0
+        self.cells = [[] for _ in range(self.size * self.size)]
+
+    @classmethod
+    def for_bboxes(cls, bboxes):
+        """ Make a grid covering the given bboxes, sized for their number. """
+        bboxes = [b for b in bboxes if b is not None]
+        if not bboxes:
+            return cls(0, 0, 1, 1, 1)
+        return cls(
+            min(b[0] for b in bboxes),
+            min(b[1] for b in bboxes),
+            max(b[2] for b in bboxes),
+            max(b[3] for b in bboxes),
+            min(64, int(math.sqrt(len(bboxes))) // 2 + 1),
+        )
+
+    def _col(self, x):
+        return min(self.size - 1, max(0, int((x - self.x0) // self.cell_width)))
+
+    def _row(self, y):
+        return min(self.size - 1, max(0, int((y - self.y0) // self.cell_height)))
+
+    def insert(self, item, bbox):
+        x0, y0, x1, y1 = bbox
+        x0, x1 = min(x0, x1), max(x0, x1)
+        y0, y1 = min(y0, y1), max(y0, y1)
+        size = self.size
+        for row in range(self._row(y0), self._row(y1) + 1):
+            for col in range(self._col(x0), self._col(x1) + 1):
+                self.cells[row * size + col].append(item)
+
+    def overlapping(self, x0, y0, x1, y1):
+        """ Return the set of items registered in any cell overlapping the
+        given bbox. Callers still need to check each item's exact bbox. """
+        x0, x1 = min(x0, x1), max(x0, x1)
+        y0, y1 = min(y0, y1), max(y0, y1)
+        size = self.size
+        found = set()
+        for row in range(self._row(y0), self._row(y1) + 1):
+            for col in range(self._col(x0), self._col(x1) + 1):
+                found.update(self.cells[row * size + col])
+        return found
+
+
+def _box_in_box(outer, inner):
+    return outer[0] <= inner[0] and outer[2] >= inner[2] and \
+        outer[1] <= inner[1] and outer[3] >= inner[3]
+
+
+def nest_by_bbox(root, elements, bboxes=None):
+    """
+        Append elements to root so that elements that fit inside other
+        elements become children of them. Elements are given in the order
+        they were generated. bboxes, if given, are the elements' bboxes as
+        returned by element_bbox().
+
+        This builds exactly the same tree as calling _append_sorted() with
+        _comp_bbox() for each element in turn, including its tie-breaking for
+        overlapping and identical boxes, but each bbox is parsed once and
+        each step only visits siblings whose bboxes intersect the element's
+        instead of rescanning every child of the page.
+    """
+    if bboxes is None:
+        bboxes = [element_bbox(el) for el in elements]
+    parents, order = nest_indexes(bboxes)
+    for i in order:
+        container = root if parents[i] < 0 else elements[parents[i]]
+        container.append(elements[i])
+
+
+def _gridable(bbox):
+    """ Whether bbox's coordinates can be placed in grid cells (not inf,
+    NaN or so large that cell arithmetic overflows). """
+    return all(-1e300 < v < 1e300 for v in bbox)
+
+
+def nest_indexes(bboxes):
+    """
+        Work out the nesting nest_by_bbox() builds for elements with the
+        given bboxes (None for elements without one), without needing the
+        elements. Returns (parents, order): parents[i] is the index of the
+        element i goes inside, or -1 for the root, and order lists indexes
+        in the order elements are appended to their parents.
+    """
+    grid = BBoxGrid.for_bboxes([b if b is not None and _gridable(b) else None for b in bboxes])
+    # entries for bboxes that can't go in the grid, checked every time
+    unbounded = []
+    parents = [None] * len(bboxes)
+    positions = [None] * len(bboxes)
+    counter = itertools.count()
+    root_key = -1
+
+    def append(container, i):
+        parents[i] = container
+        positions[i] = position = next(counter)
+        if bboxes[i] is not None:
+            if _gridable(bboxes[i]):
+                grid.insert((i, position), bboxes[i])
+            else:
+                unbounded.append((i, position))
+
+    def children_near(container, bbox):
+        if not _gridable(bbox):
+            found = set(i for i, parent in enumerate(parents)
+                        if parent == container and bboxes[i] is not None)
+            return sorted(found, key=positions.__getitem__)
+        # the grid keeps stale entries for elements that have since moved,
+        # so only keep entries matching an element's current position
+        found = set(i for i, position in itertools.chain(grid.overlapping(*bbox), unbounded)
+                    if parents[i] == container and positions[i] == position)
+        return sorted(found, key=positions.__getitem__)
+
+    def insert(container, i):
+        bbox = bboxes[i]
+        if bbox is not None:
+            for child in children_near(container, bbox):
+                if _box_in_box(bboxes[child], bbox):
+                    # fits inside child, add to child and stop
+                    insert(child, i)
+                    return
+                if _box_in_box(bbox, bboxes[child]):
+                    # child fits inside, move child into this element
+                    insert(i, child)
+        append(container, i)
+
+    for i in range(len(bboxes)):
+        insert(root_key, i)
+
+    return parents, sorted(range(len(bboxes)), key=positions.__getitem__)
+
+
+# numbers as XPath reads attribute values; anything else compares as NaN
+_xpath_number = re.compile(r'\s*-?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?\s*$')
+
+
+def _xpath_bbox(el):
+    values = [el.get(key) for key in _bbox_keys]
+    if None in values or not all(_xpath_number.match(v) for v in values):
+        return None
+    return tuple(float(v) for v in values)
+
+
+class BBoxIndex(object):
+    """
+        Spatial index of the elements of a page (or any subtree) that have
+        x0/y0/x1/y1 attributes. Queries match exactly the elements the
+        :in_bbox() and :overlaps_bbox() selectors match within the subtree,
+        in document order, but only check elements near the query bbox.
+    """
+
+    def __init__(self, page):
+        self.page = page
+        self.elements = []
+        self.bboxes = []
+        geometry = page_geometry(page)
+        for el in page.iter():
+            bbox = geometry and geometry.get(el)
+            if bbox is None:
+                bbox = _xpath_bbox(el)
+            elif not all(v - v == 0 for v in bbox):
+                bbox = None  # XPath reads inf and nan attributes as NaN
+            if bbox is not None:
+                self.elements.append(el)
+                self.bboxes.append(bbox)
+        # infinite coordinates can't be placed in grid cells, so elements
+        # that have them are checked on every query
+        finite = [i for i, bbox in enumerate(self.bboxes)
+                  if not any(math.isinf(v) for v in bbox)]
+        self.unbounded = sorted(set(range(len(self.bboxes))) - set(finite))
+        self.grid = BBoxGrid.for_bboxes([self.bboxes[i] for i in finite])
+        for i in finite:
+            self.grid.insert(i, self.bboxes[i])
+
+    def query(self, x0, y0, x1, y1, tags=None, overlap=False):
+        """
+            Return elements within the bbox, or overlapping it if overlap is
+            set. tags can be a tag name or list of tag names to return.
+        """
+        if isinstance(tags, six.string_types):
+            tags = (tags,)
+        bboxes = self.bboxes
+        found = []
+        candidates = self.grid.overlapping(*[max(-1e300, min(1e300, v)) for v in (x0, y0, x1, y1)])
+        for i in itertools.chain(candidates, self.unbounded):
+            b = bboxes[i]
+            if overlap:
+                match = b[0] <= x1 and b[1] <= y1 and b[2] >= x0 and b[3] >= y0
+            else:
+                match = b[0] >= x0 and b[1] >= y0 and b[2] <= x1 and b[3] <= y1
+            if match and (tags is None or self.elements[i].tag in tags):
+                found.append(i)
+        found.sort()
+        # leave out elements that have been removed or moved off the page
+        page = self.page
+        return [el for el in (self.elements[i] for i in found)
+                if el is page or any(parent is page for parent in el.iterancestors())]
+
+
+def bbox_index(page):
+    """
+        Return the BBoxIndex for page, building it on first use. Indexes are
+        kept on the root of page's tree, so they last as long as the tree.
+        Elements removed from the page drop out of results, but anything
+        else that changes the page needs invalidate_bbox_indexes().
+    """
+    root = page.getroottree().getroot()
+    indexes = getattr(root, '_bbox_indexes', None)
+    if indexes is None:
+        indexes = root._bbox_indexes = {}
+    if page not in indexes:
+        indexes[page] = BBoxIndex(page)
+    return indexes[page]
+
+
+def invalidate_bbox_indexes(el):
+    """ Drop the bbox indexes of el's tree, to be rebuilt on next use. """
+    root = el.getroottree().getroot()
+    if getattr(root, '_bbox_indexes', None):
+        root._bbox_indexes = {}
@@ -0,0 +1,78 @@
+"""
+Timings and counters collected by PDFQuery(stats=PDFQueryStats()).
+"""
+import time
+
+# wall clock for timing stages
+timer = getattr(time, 'perf_counter', time.time)
+
+
+class PDFQueryStats(object):
+    """
+        Where a PDFQuery spends its time, page by page. Stages are:
+
+        * layout: pdfminer laying out the page
+        * xmlize: converting the layout to elements
+        * resort: nesting elements by bounding box
+        * sort: ordering elements top to bottom and left to right
+        * clean_text: removing child text from parents and formatting text
+        * cache_get and cache_set: parse tree cache lookups and writes
+        * query: running a selector with pdf.pq, a compiled selector or
+          extract(), not counting pages a lazy tree builds for it
+        * extract: running extract(), for the whole tree it was given
+
+        pages maps each page_index to the seconds spent on it per stage,
+        and elements maps it to counts of the page's elements by tag.
+        totals has the seconds per stage across all pages. Pages built by
+        worker processes only report the stages run in this process.
+
+        hook, if given, is called as hook(name, page_index, value) for each
+        stage timing (value in seconds) and for the counters 'cache_hit',
+        'cache_miss' and 'bytes_serialized', so they can be forwarded to a
+        metrics system as they happen. page_index is None for query and
+        extract.
+    """
+
+    def __init__(self, hook=None):
+        self.hook = hook
+        self.pages = {}
+        self.elements = {}
+        self.totals = {}
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.bytes_serialized = 0
+
+    def record_time(self, stage, page_index, seconds):
+        if page_index is not None:
+            page = self.pages.setdefault(page_index, {})
+            page[stage] = page.get(stage, 0) + seconds
+        self.totals[stage] = self.totals.get(stage, 0) + seconds
+        if self.hook:
+            self.hook(stage, page_index, seconds)
+
+    def record_cache_lookup(self, page_index, hit):
+        if hit:
+            self.cache_hits += 1
+        else:
+            self.cache_misses += 1
+        if self.hook:
+            self.hook('cache_hit' if hit else 'cache_miss', page_index, 1)
+
+    def record_bytes_serialized(self, page_index, count):
+        self.bytes_serialized += count
+        if self.hook:
+            self.hook('bytes_serialized', page_index, count)
+
+    def record_elements(self, page_index, page):
+        counts = self.elements[page_index] = {}
+        for el in page.iter():
+            counts[el.tag] = counts.get(el.tag, 0) + 1
+
+    def as_dict(self):
+        return dict(pages=self.pages, elements=self.elements, totals=self.totals,
+                    cache_hits=self.cache_hits, cache_misses=self.cache_misses,
+                    bytes_serialized=self.bytes_serialized)
+
+    def __repr__(self):
+        return "<PDFQueryStats %s>" % ", ".join(
+            "%s=%.3fs" % (stage, seconds) for stage, seconds in sorted(self.totals.items()))
@@ -5,15 +5,37 @@
 # pip install nose
 # nosetests --pdb
 
+import copy
+import cssselect
+import gc
+import os
+import random
+import shutil
 import sys
+import tempfile
+import threading
+import weakref
+from concurrent.futures.process import BrokenProcessPool
 import pdfquery
-from pdfquery.cache import FileCache
+from pdfquery import cache
+from pdfquery.cache import FileCache, LRUFileCache, MemoryLRUCache
+from pdfquery.pdfquery import LayoutElement, _append_sorted, _comp_bbox, parser
+from pdfquery.pdftranslator import PDFQueryTranslator
+from pdfquery.spatial import element_bbox, nest_by_bbox
 
-from .utils import BaseTestCase
+from lxml import etree
+from pyquery import PyQuery
+from six import BytesIO
 
-### helpers ###
+from .utils import BaseTestCase, unittest
 
+### helpers ###
 
+def tree_string(tree):
+    """ Serialize tree for exact comparison, minus the unstable index= attribute. """
+    tree = copy.deepcopy(tree)
+    etree.strip_attributes(tree, 'index')
+    return etree.tostring(tree)
 
 
 class TestPDFQuery(BaseTestCase):
@@ -80,10 +102,711 @@ class TestPDFQuery(BaseTestCase):
             'year': 2007
         })
 
+    def test_extraction_plan(self):
+        """
+            A compiled ExtractionPlan should return the same results as
+            running each search with pyquery, and be reusable.
+        """
+        plain_pq = PyQuery(self.pdf.tree.getroot(), css_translator=PDFQueryTranslator())
+        page = plain_pq('LTPage[pageid="2"]')
+        big = lambda i, el: float(el.get('width', 0)) > 500
+        searches = [
+            ('pages', 'LTPage'),
+            ('with_parent', 'LTPage[pageid="2"]'),
+            ('lines', 'LTTextLineHorizontal:in_bbox("0,500,648,1043")'),
+            ('overlapping', ':overlaps_bbox("100,100,110,110")'),
+            ('big', big),
+            ('with_formatter', 'text'),
+            ('oath', 'LTTextLineHorizontal:contains("perjury")'),
+            ('pair', 'LTPage', lambda match: (('first', 1), ('second', 2))),
+            ('with_parent', None),
+            ('with_formatter', None),
+            ('all_lines', 'LTTextLineHorizontal'),
+        ]
+        expected = {
+            'pages': list(plain_pq('LTPage')),
+            'lines': list(page('LTTextLineHorizontal:in_bbox("0,500,648,1043")')),
+            'overlapping': list(page(':overlaps_bbox("100,100,110,110")')),
+            'big': list(page('*').filter(big)),
+            'oath': page('LTTextLineHorizontal:contains("perjury")').text(),
+            'first': 1,
+            'second': 2,
+            'all_lines': list(plain_pq('LTTextLineHorizontal')),
+        }
+        plan = pdfquery.ExtractionPlan(searches)
+        for values in [self.pdf.extract(searches), self.pdf.extract(plan), self.pdf.extract(plan)]:
+            values = dict((key, list(value) if isinstance(value, PyQuery) else value)
+                          for key, value in values.items())
+            self.assertDictEqual(values, expected)
+
+        self.assertRaises(cssselect.SelectorSyntaxError, pdfquery.ExtractionPlan, [('bad', 'LTPage[')])
+
+    def test_compile(self):
+        """
+            Compiled selectors should be memoized, and select the same
+            elements as pyquery from any tree.
+        """
+        selector = 'LTTextLineHorizontal:contains("Your first name and initial")'
+        compiled = pdfquery.compile(selector)
+        stats = pdfquery.selector_cache_stats
+        hits, misses = stats.hits, stats.misses
+        self.assertIs(pdfquery.compile(selector), compiled)
+        self.assertEqual((stats.hits, stats.misses), (hits + 1, misses))
+
+        plain_pq = PyQuery(self.pdf.tree.getroot(), css_translator=PDFQueryTranslator())
+        for tree in [self.pdf.tree, self.pdf.tree.getroot(), self.pdf.pq, list(self.pdf.pq('LTPage'))]:
+            self.assertEqual(list(compiled(tree)), list(plain_pq(selector)))
+        other = pdfquery.PDFQuery("tests/samples/bug28.pdf")
+        other.load()
+        self.assertEqual(len(compiled(other.tree)), 0)
+
+        size = pdfquery.pdfquery.selector_cache_size
+        pdfquery.pdfquery.selector_cache_size = 1
+        try:
+            pdfquery.compile("LTPage LTRect")
+            self.assertIsNot(pdfquery.compile(selector), compiled)
+        finally:
+            pdfquery.pdfquery.selector_cache_size = size
+
     def test_page_numbers(self):
         self.assertEqual(self.pdf.tree.getroot()[0].get('page_label'), '1')
 
 
+class TestWorkers(BaseTestCase):
+
+    def test_workers_match_serial_load(self):
+        """
+            Pages built in worker processes should match a serial load,
+            including pageid, page_index and page_label.
+        """
+        serial = pdfquery.PDFQuery("tests/samples/IRS_1040A.pdf")
+        serial.load()
+        parallel = pdfquery.PDFQuery("tests/samples/IRS_1040A.pdf", workers=2)
+        parallel.load()
+        self.assertEqual(tree_string(parallel.tree), tree_string(serial.tree))
+        # workers are told whether they get a path or contents, since both
+        # are str on Python 2
+        self.assertEqual(parallel._worker_source(), ('path', "tests/samples/IRS_1040A.pdf"))
+
+        with open("tests/samples/IRS_1040A.pdf", 'rb') as f:
+            from_bytes = pdfquery.PDFQuery(BytesIO(f.read()), workers=2)
+        self.assertEqual(from_bytes._worker_source()[0], 'data')
+        from_bytes.load(1)
+        self.assertEqual(from_bytes.pq('LTPage').attr('page_label'), '2')
+
+
+class TestBatchExtract(BaseTestCase):
+
+    def test_batch_extract(self):
+        """
+            batch_extract() should give each document's extract() results,
+            in or out of worker processes, and report failing documents
+            without stopping.
+        """
+        searches = [
+            ('with_formatter', 'text'),
+            ('last_name', ':in_bbox("315,680,395,700")'),
+            ('with_formatter', None),
+            ('lines', 'LTTextLineHorizontal:contains("Your first name")'),
+        ]
+        paths = ["tests/samples/IRS_1040A.pdf", "tests/samples/missing.pdf", "README.rst"]
+        for workers in [1, 2]:
+            results = dict((path, (result, error)) for path, result, error in
+                           pdfquery.batch_extract(paths, searches, workers=workers, page_numbers=[0]))
+            self.assertEqual(sorted(results), sorted(paths))
+            result, error = results["tests/samples/IRS_1040A.pdf"]
+            self.assertIsNone(error)
+            self.assertEqual(result['last_name'], 'Michaels Michaels')
+            self.assertEqual(result['lines'].text(), 'Your first name and initial')
+            self.assertEqual(result['lines'].attr('x0'), '143.651')
+            self.assertEqual(results["tests/samples/missing.pdf"][0], None)
+            self.assertIsInstance(results["tests/samples/missing.pdf"][1], IOError)
+            self.assertIsNotNone(results["README.rst"][1])
+
+        self.assertRaises(cssselect.SelectorSyntaxError, pdfquery.batch_extract, paths, [('bad', 'LTPage[')])
+
+    def test_batch_extract_formatter_results(self):
+        """
+            Elements returned by formatters should come back from workers,
+            and results that can't be pickled should fail only their
+            document.
+        """
+        paths = ["tests/samples/IRS_1040A.pdf", "tests/samples/bug18.pdf"]
+        searches = [
+            ('first', 'LTTextLineHorizontal:contains("Your first name")', lambda pq: pq[0]),
+            ('all', 'LTTextLineHorizontal:contains("Your first name")', lambda pq: list(pq)),
+        ]
+        pdf = pdfquery.PDFQuery(paths[0])
+        pdf.load(0)
+        expected = pdf.extract(searches)
+        for workers in [1, 2]:
+            results = dict((path, (result, error)) for path, result, error in
+                           pdfquery.batch_extract(paths, searches, workers=workers, page_numbers=[0]))
+            result, error = results["tests/samples/IRS_1040A.pdf"]
+            self.assertIsNone(error)
+            self.assertEqual(etree.tostring(result['first']), etree.tostring(expected['first'], with_tail=False))
+            self.assertEqual([etree.tostring(el) for el in result['all']],
+                             [etree.tostring(el, with_tail=False) for el in expected['all']])
+
+            unpicklable = [('lock', 'LTTextLineHorizontal:contains("Your first name")',
+                            lambda pq: threading.Lock() if len(pq) else None)]
+            results = dict((path, (result, error)) for path, result, error in
+                           pdfquery.batch_extract(paths, unpicklable, workers=workers, page_numbers=[0]))
+            self.assertIsNotNone(results["tests/samples/IRS_1040A.pdf"][1])
+            self.assertEqual(results["tests/samples/bug18.pdf"], ({'lock': None}, None))
+
+        # a document that kills its worker fails alone, and the rest still run
+        paths = ["tests/samples/bug18.pdf", "tests/samples/IRS_1040A.pdf", "tests/samples/bug28.pdf",
+                 "tests/samples/bug37.pdf", "tests/samples/bug39.pdf"]
+        crash = [('crash', 'LTTextLineHorizontal:contains("Your first name")',
+                  lambda pq: os._exit(1) if len(pq) else None)]
+        results = dict((path, (result, error)) for path, result, error in
+                       pdfquery.batch_extract(paths, crash, workers=2, page_numbers=[0]))
+        self.assertEqual(sorted(results), sorted(paths))
+        self.assertIsInstance(results["tests/samples/IRS_1040A.pdf"][1], BrokenProcessPool)
+        for path in paths:
+            if path != "tests/samples/IRS_1040A.pdf":
+                self.assertEqual(results[path], ({'crash': None}, None))
+
+
+class TestAsync(BaseTestCase):
+
+    @unittest.skipIf(sys.version_info < (3, 5), "pdfquery.aio requires Python 3.5")
+    def test_async_pdfquery(self):
+        """ AsyncPDFQuery and async_extract() should match PDFQuery. """
+        import asyncio
+        from pdfquery.aio import AsyncPDFQuery, async_extract
+        searches = [('with_formatter', 'text'), ('last_name', ':in_bbox("315,680,395,700")')]
+        loop = asyncio.new_event_loop()
+        try:
+            pdf = loop.run_until_complete(AsyncPDFQuery.open("tests/samples/IRS_1040A.pdf"))
+            loop.run_until_complete(pdf.load(0, 1))
+            expected = pdfquery.PDFQuery("tests/samples/IRS_1040A.pdf")
+            expected.load(0, 1)
+            self.assertEqual(tree_string(pdf.pdf.tree), tree_string(expected.tree))
+            self.assertEqual(loop.run_until_complete(pdf.extract(searches)), {'last_name': 'Michaels Michaels'})
+            loop.run_until_complete(pdf.close())
+            self.assertTrue(pdf.pdf.file.closed)
+
+            # worker processes build a batch of pages per call, and lazy
+            # documents build pages when extract() needs them
+            pdf = loop.run_until_complete(AsyncPDFQuery.open("tests/samples/IRS_1040A.pdf", workers=2))
+            calls = []
+            build = pdf.pdf._build_pages_in_workers
+            pdf.pdf._build_pages_in_workers = lambda page_numbers: calls.append(page_numbers) or build(page_numbers)
+            loop.run_until_complete(pdf.load())
+            self.assertEqual(calls, [[0, 1]])
+            self.assertEqual(tree_string(pdf.pdf.tree), tree_string(expected.tree))
+            pdf = loop.run_until_complete(AsyncPDFQuery.open("tests/samples/IRS_1040A.pdf", lazy=True))
+            loop.run_until_complete(pdf.load())
+            self.assertEqual(len(pdf.pdf.tree.getroot()._placeholders), 2)
+            self.assertEqual(loop.run_until_complete(pdf.extract(searches)), {'last_name': 'Michaels Michaels'})
+
+            result = loop.run_until_complete(async_extract("tests/samples/IRS_1040A.pdf", searches, [0]))
+            self.assertEqual(result, {'last_name': 'Michaels Michaels'})
+            self.assertRaises(IOError, loop.run_until_complete,
+                              async_extract("tests/samples/missing.pdf", searches))
+        finally:
+            loop.close()
+
+    @unittest.skipIf(sys.version_info < (3, 5), "pdfquery.aio requires Python 3.5")
+    def test_concurrent_shared_cache(self):
+        """
+            Documents loading at the same time should be able to share a
+            cache without their pages being stored under each other's keys.
+        """
+        import asyncio
+        from concurrent.futures import ThreadPoolExecutor
+        import pdfquery.aio
+        paths = ["tests/samples/IRS_1040A.pdf", "tests/samples/bug18.pdf"] * 4
+        searches = [('with_formatter', 'text'), ('lines', 'LTPage[page_index="0"] LTTextLineHorizontal')]
+        expected = dict((path, pdfquery.PDFQuery(path).extract(searches)) for path in set(paths))
+
+        # documents opened before either is loaded
+        cache = MemoryLRUCache()
+        pdfs = [pdfquery.PDFQuery(path, parse_tree_cacher=cache) for path in paths[:2]]
+        self.assertEqual([pdf.extract(searches) for pdf in pdfs], [expected[path] for path in paths[:2]])
+
+        cache = MemoryLRUCache()
+        concurrency = pdfquery.aio.concurrency
+        pdfquery.aio.concurrency = len(paths)
+        loop = asyncio.new_event_loop()
+        try:
+            with ThreadPoolExecutor(len(paths)) as executor:
+                tasks = [loop.create_task(pdfquery.aio.async_extract(
+                    path, searches, [0], executor=executor, parse_tree_cacher=cache)) for path in paths]
+                loop.run_until_complete(asyncio.wait(tasks))
+            results = [task.result() for task in tasks]
+        finally:
+            loop.close()
+            pdfquery.aio.concurrency = concurrency
+        self.assertEqual(results, [expected[path] for path in paths])
+        self.assertEqual(len(set(hash_key for hash_key, page_key in cache.entries)), 2)
+        for path in set(paths):
+            pdf = pdfquery.PDFQuery(path, parse_tree_cacher=cache)
+            self.assertEqual(pdf.extract(searches), expected[path])
+
+
+class TestLazy(BaseTestCase):
+
+    def test_lazy_pages(self):
+        """
+            With lazy=True, pages should start as placeholders with the
+            attributes they'll have once built, be built only when a query
+            needs them, and end up the same as a normal load.
+        """
+        expected = pdfquery.PDFQuery("tests/samples/IRS_1040A.pdf")
+        expected.load()
+        pdf = pdfquery.PDFQuery("tests/samples/IRS_1040A.pdf", lazy=True)
+        pdf.load()
+        root = pdf.tree.getroot()
+        self.assertEqual([len(page) for page in root], [0, 0])
+        self.assertEqual([page.attrib for page in root], [page.attrib for page in expected.tree.getroot()])
+
+        lines = pdf.pq('LTPage[page_index="1"] LTTextLineHorizontal:contains("perjury")')
+        self.assertEqual(lines.text()[:30], 'Under penalties of perjury, I ')
+        self.assertEqual([len(page) > 0 for page in root], [False, True])
+
+        self.assertEqual(pdf.extract([
+            ('with_parent', 'LTPage[page_index="0"]'),
+            ('with_formatter', 'text'),
+            ('last_name', ':in_bbox("315,680,395,700")'),
+        ]), {'last_name': 'Michaels Michaels'})
+        self.assertEqual(tree_string(pdf.tree), tree_string(expected.tree))
+
+        pdf = pdfquery.PDFQuery("tests/samples/IRS_1040A.pdf", lazy=True)
+        pdf.load()
+        self.assertEqual(pdf.query_bbox(0, 315, 680, 395, 700, tags='LTTextLineHorizontal').text(), 'Michaels')
+        self.assertEqual(pdf.pq('LTPage')[1].layout.bbox, (0, 0, 648, 1043))
+        self.assertEqual(len(pdf.pq('LTTextLineHorizontal')), len(expected.pq('LTTextLineHorizontal')))
+
+
+class TestStats(BaseTestCase):
+
+    def test_stats(self):
+        """
+            stats should time each stage per page, count elements and cache
+            use, and report them to the hook as they happen.
+        """
+        events = []
+        stats = pdfquery.PDFQueryStats(hook=lambda *event: events.append(event))
+        cache = MemoryLRUCache()
+        pdf = pdfquery.PDFQuery("tests/samples/IRS_1040A.pdf", parse_tree_cacher=cache, stats=stats)
+        pdf.load(0)
+        self.assertEqual(sorted(stats.pages[0]), [
+            'cache_get', 'cache_set', 'clean_text', 'layout', 'resort', 'sort', 'xmlize'])
+        self.assertEqual(stats.elements[0]['LTPage'], 1)
+        self.assertEqual(sum(stats.elements[0].values()), len(list(pdf.tree.getroot()[0].iter())))
+        self.assertEqual((stats.cache_hits, stats.cache_misses), (0, 1))
+        self.assertEqual(stats.bytes_serialized, cache.stats.bytes_written)
+        self.assertTrue(stats.bytes_serialized > 0)
+
+        pdf.pq('LTTextLineHorizontal:contains("Your first name")')
+        self.assertEqual([name for name, page_index, value in events if page_index is None], ['query'])
+        pdf.extract([('last_name', ':in_bbox("315,680,395,700")')])
+        pdfquery.PDFQuery("tests/samples/IRS_1040A.pdf", parse_tree_cacher=cache, stats=stats).load(0)
+        self.assertEqual((stats.cache_hits, stats.cache_misses), (1, 1))
+        self.assertTrue('extract' in stats.totals)
+        self.assertTrue(('cache_hit', 0, 1) in events)
+        self.assertEqual([name for name, page_index, value in events if page_index is None],
+                         ['query', 'query', 'extract'])
+
+
+class TestTextInBboxes(BaseTestCase):
+
+    def test_text_in_bboxes(self):
+        """
+            text_in_bboxes() should match the text of :in_bbox() text lines,
+            and words() should split lines into positioned words, without
+            building a tree or changing later pageids.
+        """
+        pdf = pdfquery.PDFQuery("tests/samples/IRS_1040A.pdf")
+        bboxes = [(315, 680, 395, 700), (170, 680, 210, 700), (0, 0, 1, 1),
+                  (30, 560, 300, 650), (500, 550, 620, 700)]
+        self.assertEqual(pdf.text_in_bboxes(0, bboxes)[:3], ['Michaels', 'John E.', ''])
+        words = pdf.words(0)
+        self.assertTrue((316.771, 686.25, 352.001, 698.678, 'Michaels') in words)
+        self.assertTrue(all(' ' not in word[4] for word in words))
+        self.assertIsNone(pdf.tree)
+
+        pdf.load(0)
+        self.assertEqual(pdf.pq('LTPage').attr('pageid'), '1')
+        for text, bbox in zip(pdf.text_in_bboxes(0, bboxes), bboxes):
+            # a line's text moves to a text box nested inside it if they're
+            # the same size
+            lines = pdf.pq('LTTextLineHorizontal:in_bbox("%s,%s,%s,%s"), '
+                           'LTTextLineVertical:in_bbox("%s,%s,%s,%s")' % (bbox + bbox))
+            self.assertEqual(text, ' '.join(' '.join((line.text or ''.join(line.itertext())).split())
+                                            for line in lines))
+
+        # a link annotation around some of the lines nests them, changing their order
+        pdf = pdfquery.PDFQuery("tests/samples/IRS_1040A.pdf")
+        pdf._add_annots = lambda layout, annots: pdfquery.PDFQuery._add_annots(
+            pdf, layout, [{'Subtype': 'Link', 'Rect': [430, 900, 490, 975]}])
+        bboxes = [(420, 900, 600, 980)]
+        texts = pdf.text_in_bboxes(0, bboxes)
+        pdf.load(0)
+        self.assertEqual(len(pdf.pq('Annot LTTextLineHorizontal')), 4)
+        for text, bbox in zip(texts, bboxes):
+            lines = pdf.pq('LTTextLineHorizontal:in_bbox("%s,%s,%s,%s"), '
+                           'LTTextLineVertical:in_bbox("%s,%s,%s,%s")' % (bbox + bbox))
+            self.assertEqual(text, ' '.join(' '.join((line.text or ''.join(line.itertext())).split())
+                                            for line in lines))
+
+
+class TestCharLevel(BaseTestCase):
+
+    def test_char_level(self):
+        """
+            char_level='merge' should build the usual tree without
+            allocating elements for characters that end up merged away;
+            'drop' and 'full' should leave out or keep every character.
+        """
+        merged = pdfquery.PDFQuery("tests/samples/IRS_1040A.pdf")
+        merged.load(0)
+        page = merged.pq('LTPage')[0]
+        self.assertEqual(len(page._elements), len(list(page.iter())) - 1)
+
+        dropped = pdfquery.PDFQuery("tests/samples/IRS_1040A.pdf", char_level='drop')
+        dropped.load(0)
+        self.assertEqual(tree_string(dropped.tree), tree_string(merged.tree))
+
+        full = pdfquery.PDFQuery("tests/samples/IRS_1040A.pdf", char_level='full')
+        full.load(0)
+        line = merged.pq('LTTextLineHorizontal:contains("Your first name and initial")')
+        chars = full.pq('LTChar:in_bbox("%s,%s,%s,%s")' % tuple(line.attr(k) for k in ('x0', 'y0', 'x1', 'y1')))
+        self.assertEqual(''.join(char.text for char in chars), 'Your first name and initial')
+        self.assertGreater(len(full.pq('LTChar')), 10 * len(merged.pq('LTTextLineHorizontal')))
+
+        self.assertRaises(ValueError, pdfquery.PDFQuery, "tests/samples/IRS_1040A.pdf", char_level='glyph')
+
+
+class TestAttributes(BaseTestCase):
+
+    def test_attributes(self):
+        """
+            attributes= should limit the layout attributes copied to
+            elements, always keeping the bbox coordinates.
+        """
+        pdf = pdfquery.PDFQuery("tests/samples/IRS_1040A.pdf", attributes=['width'])
+        pdf.load(0)
+        line = pdf.pq('LTTextLineHorizontal:contains("Your first name and initial")')
+        self.assertEqual(sorted(line[0].attrib), ['width', 'x0', 'x1', 'y0', 'y1'])
+        self.assertEqual(line.attr('x0'), '143.651')
+        self.assertEqual(sorted(pdf.pq('LTPage')[0].attrib), ['page_index', 'page_label', 'width', 'x0', 'x1', 'y0', 'y1'])
+
+    def test_value_to_string(self):
+        """ The fast paths should give the same strings as obj_to_string(). """
+        pdf = pdfquery.PDFQuery("tests/samples/bug28.pdf")
+        values = [1.23456, -0.0, 3, True, None, float('inf'), float('nan'), (1.23456, 2, 3.0),
+                  [(1.5, 2.25555), (3, 4)], (1, 'a'), [True, 1.0], b'abc', u'abc', (), {'a': 1}]
+        for round_floats in [True, False]:
+            pdf.round_floats = round_floats
+            for value in values:
+                self.assertEqual(pdf._value_to_string(value),
+                                 pdfquery.pdfquery.obj_to_string(pdf._filter_value(value)))
+
+
+class TestLifecycle(BaseTestCase):
+
+    def test_close(self):
+        """
+            Layouts should live as long as the tree that uses them, and
+            close() should release the tree and close files PDFQuery opened.
+        """
+        with pdfquery.PDFQuery("tests/samples/IRS_1040A.pdf") as pdf:
+            pdf.load(0)
+            line = pdf.pq('LTTextLineHorizontal:contains("Your first name and initial")')
+            layout = weakref.ref(line[0].layout)
+            self.assertEqual(layout().get_text().strip(), 'Your first name and initial')
+            del line
+            gc.collect()
+            self.assertIsNotNone(layout())
+        self.assertIsNone(pdf.tree)
+        self.assertTrue(pdf.file.closed)
+        gc.collect()
+        self.assertIsNone(layout())
+
+        with open("tests/samples/IRS_1040A.pdf", 'rb') as f:
+            pdfquery.PDFQuery(f).close()
+            self.assertFalse(f.closed)
+
+    def test_keep_layout(self):
+        """ keep_layout=False should build the same tree without layouts. """
+        pdf = pdfquery.PDFQuery("tests/samples/IRS_1040A.pdf", keep_layout=False)
+        pdf.load(0)
+        expected = pdfquery.PDFQuery("tests/samples/IRS_1040A.pdf")
+        expected.load(0)
+        self.assertEqual(tree_string(pdf.tree), tree_string(expected.tree))
+        self.assertIsNone(pdf.pq('LTTextLineHorizontal')[0].layout)
+        self.assertIsNone(pdf.device.result)
+
+    def test_release_pages(self):
+        """ release_pages() should drop pages from the tree and free them. """
+        pdf = pdfquery.PDFQuery("tests/samples/IRS_1040A.pdf")
+        pdf.load()
+        layout = weakref.ref(pdf.pq('LTPage')[0].layout)
+        pdf.query_bbox(0, 0, 0, 1000, 1000)
+        pdf.release_pages(0)
+        gc.collect()
+        self.assertIsNone(layout())
+        self.assertEqual(pdf.tree.getroot()._bbox_indexes, {})
+        self.assertEqual([page.get('page_index') for page in pdf.pq('LTPage')], ['1'])
+        self.assertEqual(pdf.pq('LTPage')[0].layout.pageid, 2)
+        pdf.release_pages()
+        self.assertEqual(len(pdf.pq('LTPage')), 0)
+
+
+class TestFileInput(BaseTestCase):
+
+    def test_memory_map_and_bytes(self):
+        """
+            Memory-mapped files and bytes-like objects should build the same
+            tree as a file read normally, and get the same cache key.
+        """
+        path = "tests/samples/IRS_1040A.pdf"
+        expected = pdfquery.PDFQuery(path, parse_tree_cacher=MemoryLRUCache())
+        expected.load(0)
+        with open(path, 'rb') as f:
+            data = f.read()
+        sources = [(path, dict(memory_map=True)), (data, {}), (memoryview(bytearray(data)), {}),
+                   (path.encode('ascii'), {})]
+        for source, options in sources:
+            cache = MemoryLRUCache()
+            with pdfquery.PDFQuery(source, parse_tree_cacher=cache, **options) as pdf:
+                pdf.load(0)
+                self.assertEqual(tree_string(pdf.tree), tree_string(expected.tree))
+                self.assertEqual(pdf._hash_key, expected._hash_key)
+            self.assertTrue(pdf.file.closed)
+
+        with open(path, 'rb') as f:
+            with pdfquery.PDFQuery(f, memory_map=True) as pdf:
+                self.assertIs(pdf.file.file, f)
+            self.assertFalse(f.closed)
+        self.assertFalse(isinstance(pdfquery.PDFQuery(BytesIO(data), memory_map=True).file,
+                                    pdfquery.pdfquery.BufferFile))
+
+class TestIterPages(BaseTestCase):
+
+    def test_iter_pages(self):
+        """
+            iter_pages() should give the same results as querying a loaded
+            tree, without keeping earlier pages around.
+        """
+        pdf = pdfquery.PDFQuery("tests/samples/IRS_1040A.pdf")
+        results = []
+        for n, lines in pdf.iter_pages('LTTextLineHorizontal:contains("perjury")'):
+            results.append((n, lines.text()[:30]))
+        self.assertEqual(results, [(0, ''), (1, 'Under penalties of perjury, I ')])
+        self.assertIsNone(pdf.tree)
+        self.assertIsNone(pdf.device.result)
+
+        pages = list(pdf.iter_pages([
+            ('with_formatter', 'text'),
+            ('spouse', 'LTTextLineHorizontal:in_bbox("170,650,220,680")'),
+        ], page_numbers=[0]))
+        self.assertEqual(pages, [(0, {'spouse': 'Susan R.'})])
+
+
+class TestCache(BaseTestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp() + '/'
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_page_cache(self):
+        """
+            Pages cached by one load() should be reused by loads of other page
+            ranges, and give the same tree as parsing from scratch.
+        """
+        pdf = pdfquery.PDFQuery("tests/samples/IRS_1040A.pdf",
+                                parse_tree_cacher=FileCache(self.cache_dir))
+        pdf.load()
+
+        def no_parsing(page):
+            self.fail("page %s should have come from the cache" % page)
+
+        for page_numbers in [(1,), (1, 0), ()]:
+            cached = pdfquery.PDFQuery("tests/samples/IRS_1040A.pdf",
+                                       parse_tree_cacher=FileCache(self.cache_dir))
+            cached.get_layout = no_parsing
+            cached.load(*page_numbers)
+            uncached = pdfquery.PDFQuery("tests/samples/IRS_1040A.pdf")
+            uncached.load(*page_numbers)
+            self.assertEqual(tree_string(cached.tree), tree_string(uncached.tree))
+
+        # other options shouldn't share cached pages
+        pdf = pdfquery.PDFQuery("tests/samples/IRS_1040A.pdf", round_digits=1,
+                                parse_tree_cacher=FileCache(self.cache_dir))
+        pdf.load(0)
+        self.assertEqual(pdf.pq('LTPage').attr('y1'), '1043')
+        label = pdf.pq('LTTextLineHorizontal:contains("Your first name and initial")')
+        self.assertEqual(label.attr('x0'), '143.7')
+
+    def test_fast_file_identity(self):
+        """
+            file_identity='fast' should reuse caches for the same file, and
+            tell apart files that differ.
+        """
+        pdf = pdfquery.PDFQuery("tests/samples/IRS_1040A.pdf",
+                                parse_tree_cacher=FileCache(self.cache_dir, file_identity='fast'))
+        pdf.load(0)
+        cached = pdfquery.PDFQuery("tests/samples/IRS_1040A.pdf",
+                                   parse_tree_cacher=FileCache(self.cache_dir, file_identity='fast'))
+        cached.get_layout = lambda page: self.fail("page should have come from the cache")
+        cached.load(0)
+        self.assertEqual(tree_string(cached.tree), tree_string(pdf.tree))
+
+        hash_keys = set()
+        for path in ["tests/samples/IRS_1040A.pdf", "tests/samples/bug11.pdf"]:
+            with open(path, 'rb') as f:
+                for data in [f, BytesIO(f.read())]:
+                    cache = FileCache(self.cache_dir, file_identity='fast')
+                    cache.set_hash_key(data)
+                    hash_keys.add(cache.hash_key)
+        self.assertEqual(len(hash_keys), 4)
+
+        self.assertRaises(ValueError, FileCache, self.cache_dir, file_identity='size')
+
+    def test_serialize_tree(self):
+        pdf = pdfquery.PDFQuery("tests/samples/bug28.pdf")
+        pdf.load()
+        for codec in list(cache._codecs) + ['auto']:
+            data = cache.serialize_tree(pdf.tree, codec)
+            self.assertEqual(etree.tostring(cache.deserialize_tree(data).getroot()),
+                             etree.tostring(pdf.tree.getroot()))
+        self.assertRaises(ValueError, cache.serialize_tree, pdf.tree, 'bz2')
+
+        # files from other formats or versions are cache misses
+        file_cache = FileCache(self.cache_dir)
+        file_cache.set_hash_key(pdf.file)
+        with open(file_cache.get_cache_path('_test'), 'wb') as f:
+            f.write(data[:4] + b'\x01' + data[5:])
+        self.assertIsNone(file_cache.get('_test'))
+        self.assertEqual(file_cache.stats.misses, 1)
+
+        # so are truncated or corrupted files
+        for codec in cache._codecs:
+            data = cache.serialize_tree(pdf.tree, codec)
+            for corrupted in [data[:len(data) // 2], data[:6] + b'\x00' * 8 + data[14:]]:
+                with open(file_cache.get_cache_path('_test'), 'wb') as f:
+                    f.write(corrupted)
+                self.assertIsNone(file_cache.get('_test'))
+
+    def test_corrupted_cache_file(self):
+        """ load() should rebuild pages whose cache files are corrupted, and
+        failed writes shouldn't leave temporary files behind. """
+        file_cache = FileCache(self.cache_dir)
+        pdf = pdfquery.PDFQuery("tests/samples/IRS_1040A.pdf", parse_tree_cacher=file_cache)
+        pdf.load(0)
+        path = file_cache.get_cache_path(pdf._page_cache_key(0), pdf._hash_key)
+        with open(path, 'rb') as f:
+            data = f.read()
+        with open(path, 'wb') as f:
+            f.write(data[:len(data) // 2])
+        pdf = pdfquery.PDFQuery("tests/samples/IRS_1040A.pdf", parse_tree_cacher=file_cache)
+        pdf.load(0)
+        self.assertEqual(pdf.pq('LTTextLineHorizontal:in_bbox("315,680,395,700")').text(), 'Michaels')
+
+        os.remove(path)
+        os.mkdir(path)  # can't be replaced by a file
+        self.assertRaises(OSError, file_cache.set, pdf._page_cache_key(0), pdf.tree, pdf._hash_key)
+        self.assertEqual(os.listdir(self.cache_dir), [os.path.basename(path)])
+
+        # threads writing the same page each use their own temporary file
+        os.rmdir(path)
+        errors = []
+
+        def write():
+            try:
+                for _ in range(10):
+                    file_cache.set(pdf._page_cache_key(0), pdf.tree, pdf._hash_key)
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=write) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(os.listdir(self.cache_dir), [os.path.basename(path)])
+
+    def test_cache_hit_layout(self):
+        """
+            Pages from the cache should be LayoutElements that load their
+            .layout from pdfminer when asked.
+        """
+        file_cache = FileCache(self.cache_dir)
+        pdf = pdfquery.PDFQuery("tests/samples/IRS_1040A.pdf", parse_tree_cacher=file_cache)
+        pdf.load(0)
+        cached = pdfquery.PDFQuery("tests/samples/IRS_1040A.pdf", parse_tree_cacher=file_cache)
+        cached.load(0)
+        self.assertEqual(file_cache.stats.hits, 1)
+        self.assertIsInstance(file_cache.get(pdf._page_cache_key(0), pdf._hash_key), etree._ElementTree)
+
+        label = cached.pq('LTTextLineHorizontal:contains("Your first name and initial")')[0]
+        self.assertIsInstance(label, LayoutElement)
+        self.assertIn("Your first name and initial", label.layout.get_text())
+        self.assertEqual(cached.pq('LTPage')[0].layout.pageid, 1)
+        self.assertIsNone(cached.tree.getroot().layout)
+
+        # annotations can be laid out more than once
+        pdf = pdfquery.PDFQuery("tests/samples/bug28.pdf")
+        annots = [etree.tostring(annot) for annot in pdf.get_tree().iter('Annot')]
+        self.assertEqual([etree.tostring(annot) for annot in pdf.get_tree().iter('Annot')], annots)
+
+    def test_memory_lru_cache(self):
+        cache = MemoryLRUCache(max_entries=1)
+        pdf = pdfquery.PDFQuery("tests/samples/IRS_1040A.pdf", parse_tree_cacher=cache)
+        pdf.load(0)
+        pdf.load(0)
+        pdf.load(1)  # evicts page 0
+        self.assertEqual((cache.stats.hits, cache.stats.misses, cache.stats.evictions), (1, 2, 1))
+        self.assertEqual(len(cache.entries), 1)
+        self.assertEqual(cache.stats.bytes, len(list(cache.entries.values())[0]))
+
+        cache = MemoryLRUCache(max_bytes=1)
+        pdf = pdfquery.PDFQuery("tests/samples/IRS_1040A.pdf", parse_tree_cacher=cache)
+        pdf.load(0)
+        self.assertEqual((len(cache.entries), cache.stats.bytes, cache.stats.evictions), (0, 0, 1))
+
+    def test_lru_file_cache(self):
+        # files the cache didn't write are never evicted
+        other = os.path.join(self.cache_dir, "pdfquery_other.xml")
+        with open(other, "wb") as f:
+            f.write(b"x" * 100)
+        cache = LRUFileCache(self.cache_dir, max_bytes=1)
+        pdf = pdfquery.PDFQuery("tests/samples/IRS_1040A.pdf", parse_tree_cacher=cache)
+        pdf.load(0)
+        self.assertEqual(os.listdir(self.cache_dir), ["pdfquery_other.xml"])
+        self.assertEqual((cache.stats.misses, cache.stats.evictions, cache.stats.bytes), (1, 1, 0))
+        os.remove(other)
+
+        cache = LRUFileCache(self.cache_dir, max_bytes=10 ** 9)
+        pdf = pdfquery.PDFQuery("tests/samples/IRS_1040A.pdf", parse_tree_cacher=cache)
+        pdf.load(0, 1)
+        self.assertEqual(len(os.listdir(self.cache_dir)), 2)
+        self.assertEqual(cache.stats.bytes, sum(
+            os.path.getsize(os.path.join(self.cache_dir, f)) for f in os.listdir(self.cache_dir)))
+
+        # files unused for longer than ttl are dropped on lookup
+        cache.ttl = 60
+        pdf.load(1)
+        os.utime(cache.get_cache_path(pdf._page_cache_key(0), pdf._hash_key), (0, 0))
+        pdf.load(0)
+        self.assertEqual((cache.stats.hits, cache.stats.evictions), (1, 1))
+        self.assertEqual(len(os.listdir(self.cache_dir)), 2)
+
+        # files from earlier caches are counted and evicted too
+        newest = cache.get_cache_path(pdf._page_cache_key(0), pdf._hash_key)
+        size = os.path.getsize(newest)
+        cache = LRUFileCache(self.cache_dir, max_bytes=size)
+        self.assertEqual((cache.stats.bytes, cache.stats.evictions), (size, 1))
+        self.assertEqual(os.listdir(self.cache_dir), [os.path.basename(newest)])
+
+
 class TestDocInfo(BaseTestCase):
 
     def test_docinfo(self):
@@ -134,6 +857,23 @@ class TestUnicode(BaseTestCase):
         pdf = pdfquery.PDFQuery("tests/samples/bug39.pdf")
         pdf.load(2)  # throws error if we fail to strip ascii control characters -- see issue #39
 
+    def test_smart_unicode_decode(self):
+        """
+            Byte order marks and memoized strings should decode just as
+            chardet would decode them.
+        """
+        from pdfquery.pdfquery import _chardet_decode, _decode_cache, smart_unicode_decode
+        for encoded in [b'\xfe\xff\x00I\x00n\x00s\x00p\x00e\x00c\x00t',
+                        b'\xfe\xff\xfe\xff\x00A\x00',
+                        b'\xef\xbb\xbfStra\xc3\x9fe',
+                        b'Stra\xdfe, Caf\xe9']:
+            self.assertEqual(smart_unicode_decode(encoded), _chardet_decode(encoded))
+            self.assertEqual(smart_unicode_decode(encoded), _chardet_decode(encoded))
+        self.assertEqual(smart_unicode_decode(b'\xfe\xff\x00I\x00n'), u'In')
+        self.assertTrue(b'Stra\xdfe, Caf\xe9' in _decode_cache)
+        self.assertEqual(pdfquery.pdfquery.obj_to_string(b'\xfe\xff\x00I'), u'I')
+        self.assertEqual(pdfquery.pdfquery.obj_to_string(12), u'12')
+
 
 class TestAnnotations(BaseTestCase):
     """
@@ -157,3 +897,177 @@ class TestAnnotations(BaseTestCase):
         pdf.load()
         pdf = pdfquery.PDFQuery("tests/samples/bug42.pdf")
         pdf.load()
+
+
+class TestResort(BaseTestCase):
+
+    def test_nest_by_bbox_matches_append_sorted(self):
+        """
+            nest_by_bbox() should build the same tree as _append_sorted(),
+            including for overlapping, identical, empty and infinite boxes.
+        """
+        rnd = random.Random(0)
+        for _ in range(50):
+            elements = []
+            for i in range(rnd.randrange(1, 150)):
+                if elements and rnd.random() < 0.1:
+                    attrs = dict(rnd.choice(elements).attrib)
+                else:
+                    x0, y0 = rnd.randrange(0, 100, 5), rnd.randrange(0, 100, 5)
+                    w, h = rnd.choice([0, 5, 10, 50]), rnd.choice([0, 5, 10, 50])
+                    attrs = dict(x0=str(x0), y0=str(y0), x1=str(x0 + w), y1=str(y0 + h))
+                    if rnd.random() < 0.05:
+                        attrs[rnd.choice(['x0', 'y0', 'x1', 'y1'])] = rnd.choice(['inf', '-inf', 'nan'])
+                attrs['id'] = str(i)
+                elements.append(parser.makeelement('LTRect', attrs))
+            elements.append(parser.makeelement('Annot'))
+
+            expected = parser.makeelement('LTPage')
+            for el in copy.deepcopy(elements):
+                _append_sorted(expected, el, _comp_bbox)
+            result = parser.makeelement('LTPage')
+            nest_by_bbox(result, copy.deepcopy(elements))
+            self.assertEqual(etree.tostring(result), etree.tostring(expected))
+
+    def test_sort(self):
+        """
+            _sort() should order each level top to bottom and left to right,
+            like sorting each element's children recursively, and group
+            lines within sort_tolerance.
+        """
+        def recursive_sort(tree):
+            children = list(tree)
+            if children:
+                tree[:] = sorted(children, key=lambda child: (-float(child.get('y1')), float(child.get('x0'))))
+                for child in children:
+                    recursive_sort(child)
+
+        pdf = pdfquery.PDFQuery("tests/samples/bug28.pdf")
+        rnd = random.Random(0)
+        for _ in range(20):
+            elements = [parser.makeelement('LTPage', dict(x0='0', y0='0', x1='100', y1='100'))]
+            for i in range(rnd.randrange(1, 100)):
+                x0, y0 = rnd.randrange(0, 100, 5), rnd.randrange(0, 100, 5)
+                el = parser.makeelement('LTRect', dict(x0=str(x0), y0=str(y0), x1=str(x0 + 5), y1=str(y0 + 5)))
+                rnd.choice(elements).append(el)
+                elements.append(el)
+            expected = copy.deepcopy(elements[0])
+            recursive_sort(expected)
+            pdf._sort(elements[0])
+            self.assertEqual(etree.tostring(elements[0]), etree.tostring(expected))
+
+        page = parser.makeelement('LTPage')
+        for text, x0, y1 in [('b', 50, 100.5), ('a', 10, 99.8), ('d', 30, 90), ('c', 10, 90.2), ('e', 0, 80)]:
+            page.append(parser.makeelement('LTChar', dict(x0=str(x0), y1=str(y1))))
+            page[-1].text = text
+        page.append(parser.makeelement('LTAnno'))
+        page[-1].text = 'f'
+        pdf.sort_tolerance = 1
+        pdf._sort(page)
+        self.assertEqual(''.join(el.text for el in page), 'abcdef')
+
+
+class TestCleanText(BaseTestCase):
+
+    def test_clean_text(self):
+        """
+            _clean_text() should remove each child's text from the first
+            place it occurs in its parent's remaining text, as a search and
+            replace for each child does.
+        """
+        def legacy_clean_text(branch, formatter):
+            if branch.text and formatter:
+                branch.text = formatter(branch.text)
+            try:
+                for child in branch:
+                    legacy_clean_text(child, formatter)
+                    if branch.text and branch.text.find(child.text) >= 0:
+                        branch.text = branch.text.replace(child.text, '', 1)
+            except TypeError:
+                pass
+
+        pdf = pdfquery.PDFQuery("tests/samples/bug28.pdf")
+        rnd = random.Random(0)
+        for _ in range(200):
+            elements = [parser.makeelement('LTPage')]
+            for i in range(rnd.randrange(1, 30)):
+                el = parser.makeelement('LTTextLineHorizontal')
+                if rnd.random() < 0.9:
+                    el.text = ''.join(rnd.choice('ab \n') for _ in range(rnd.randrange(4)))
+                rnd.choice(elements).append(el)
+                elements.append(el)
+            for el in reversed(elements):
+                # parents usually hold their children's text in order
+                if len(el) and rnd.random() < 0.8:
+                    texts = [child.text or '' for child in el]
+                    if rnd.random() < 0.3:
+                        rnd.shuffle(texts)
+                    el.text = ''.join(texts) + rnd.choice(['', 'a', ' b'])
+            for formatter in (None, pdf.input_text_formatter):
+                expected = copy.deepcopy(elements[0])
+                legacy_clean_text(expected, formatter)
+                result = copy.deepcopy(elements[0])
+                pdf.input_text_formatter = formatter
+                pdf._clean_text(result)
+                self.assertEqual(etree.tostring(result), etree.tostring(expected))
+
+
+class TestBBoxIndex(BaseTestCase):
+
+    def test_bbox_selectors_match_xpath(self):
+        """
+            Indexed :in_bbox and :overlaps_bbox selectors and query_bbox()
+            should return the same elements as running the selectors as
+            XPath.
+        """
+        pdf = pdfquery.PDFQuery("tests/samples/IRS_1040A.pdf")
+        pdf.load()
+        plain_pq = PyQuery(pdf.tree.getroot(), css_translator=PDFQueryTranslator())
+        pages = pdf.pq('LTPage')
+        rnd = random.Random(0)
+        for _ in range(100):
+            x0, y0 = rnd.uniform(-50, 600), rnd.uniform(-50, 800)
+            x1, y1 = x0 + rnd.uniform(-10, 300), y0 + rnd.uniform(-10, 300)
+            for function in ['in_bbox', 'overlaps_bbox']:
+                for tag in ['', '*', 'LTTextLineHorizontal']:
+                    selector = '%s:%s("%s,%s,%s,%s")' % (tag, function, x0, y0, x1, y1)
+                    expected = list(plain_pq(selector))
+                    self.assertEqual(list(pdf.pq(selector)), expected)
+                    self.assertEqual(list(pages(selector)), expected)
+            self.assertEqual(list(pdf.query_bbox(1, x0, y0, x1, y1, overlap=True)),
+                             list(plain_pq('LTPage[page_index="1"]')(':overlaps_bbox("%s,%s,%s,%s")' % (x0, y0, x1, y1))))
+
+        self.assertEqual(pdf.query_bbox(0, 315, 680, 395, 700, tags='LTTextLineHorizontal').text(), 'Michaels')
+        self.assertRaises(IndexError, pdf.query_bbox, 5, 0, 0, 1, 1)
+
+        # removed elements drop out; added ones need invalidate_bbox_indexes()
+        selector = 'LTTextLineHorizontal:in_bbox("315,680,395,700")'
+        pdf.pq(selector).remove()
+        self.assertEqual(list(pdf.pq(selector)), [])
+        self.assertEqual(list(pdf.query_bbox(0, 315, 680, 395, 700)), list(plain_pq(':in_bbox("315,680,395,700")')))
+        pdf.pq('LTPage[page_index="0"]').append(
+            '<LTTextLineHorizontal x0="320" y0="685" x1="390" y1="695">Smith</LTTextLineHorizontal>')
+        pdf.invalidate_bbox_indexes()
+        self.assertEqual(pdf.pq(selector).text(), 'Smith')
+        line = pdf.pq(selector)[0]
+        pdf.pq('LTPage[page_index="1"]').append(line)
+        self.assertEqual(list(pdf.query_bbox(0, 315, 680, 395, 700)), [])
+
+    def test_geometry(self):
+        """
+            LayoutElement.bbox should match the element's attributes, whether
+            it comes from the page's geometry table or from the cache.
+        """
+        cache = MemoryLRUCache()
+        pdf = pdfquery.PDFQuery("tests/samples/IRS_1040A.pdf", parse_tree_cacher=cache)
+        cached = pdfquery.PDFQuery("tests/samples/IRS_1040A.pdf", parse_tree_cacher=cache)
+        pdf.load(0)
+        cached.load(0)
+
+        page = pdf.pq('LTPage')[0]
+        self.assertEqual(len(page._geometry.rows), len(list(page.iter())))
+        for tree in [pdf.tree, cached.tree]:
+            for el in tree.iter():
+                self.assertEqual(el.bbox, element_bbox(el))
+        self.assertIsNone(pdf.tree.getroot().bbox)
+        self.assertEqual(page.bbox, (0.0, 0.0, 648.0, 1043.0))